@@ -0,0 +1,137 @@
+"""Compare the decoding of timeline pages into dicts and into Tweet records.
+
+    python benchmarks/bench_decode.py --pages 200
+
+Each page holds 200 generated tweets shaped like those of the v1.1 API.
+Reports the time to decode a page and read the fields used by
+process_tweet, and the memory kept by the decoded page, for json,
+orjson when installed, and the lean records.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from mock_twitter import add_arguments, make_tweet
+from download_twitter_resources.records import Tweet, loads, media_of, orjson
+
+
+def make_user(id):
+    # the fields of a user object embedded in every tweet
+    user = {
+        "id": id,
+        "id_str": str(id),
+        "name": f"User {id}",
+        "screen_name": f"user{id}",
+        "location": "Somewhere",
+        "description": "A description of the account " * 3,
+        "url": None,
+        "entities": {"description": {"urls": []}},
+        "protected": False,
+        "followers_count": 1234,
+        "friends_count": 567,
+        "listed_count": 8,
+        "created_at": "Mon Jan 01 00:00:00 +0000 2012",
+        "favourites_count": 9012,
+        "verified": False,
+        "statuses_count": 3456,
+        "lang": None,
+        "profile_background_color": "C0DEED",
+        "profile_image_url_https": "https://pbs.twimg.com/profile_images/1/a.jpg",
+        "profile_banner_url": "https://pbs.twimg.com/profile_banners/1/1",
+        "profile_link_color": "1DA1F2",
+        "default_profile": True,
+        "default_profile_image": False,
+        "following": False,
+        "follow_request_sent": False,
+        "notifications": False,
+        "translator_type": "none",
+    }
+    return user
+
+
+def make_page(options, count=200):
+    tweets = []
+    for i in range(count):
+        tweet = make_tweet(10**18 + i, options, "https://pbs.twimg.com")
+        tweet["user"] = make_user(i % 10)
+        tweet.update(
+            source='<a href="https://mobile.twitter.com">Twitter Web App</a>',
+            truncated=False,
+            in_reply_to_status_id=None,
+            in_reply_to_user_id=None,
+            geo=None,
+            coordinates=None,
+            place=None,
+            is_quote_status=False,
+            retweet_count=12,
+            favorite_count=34,
+            favorited=False,
+            retweeted=False,
+            possibly_sensitive=False,
+            lang="en",
+        )
+        if "extended_entities" in tweet:
+            tweet["entities"]["media"] = tweet["extended_entities"]["media"]
+        tweets.append(tweet)
+    return json.dumps(tweets).encode()
+
+
+def read_dicts(tweets):
+    for tweet in tweets:
+        tweet["id"], tweet["id_str"], tweet["text"], tweet["created_at"]
+        media_of(tweet)
+
+
+def read_records(tweets):
+    for tweet in tweets:
+        tweet.id, tweet.id_str, tweet.text, tweet.created_at, tweet.media
+
+
+DECODERS = {
+    "json": lambda body: json.loads(body),
+    "orjson": lambda body: orjson.loads(body),
+    "lean": lambda body: [Tweet.from_dict(x) for x in loads(body)],
+}
+
+
+def measure(name, body, pages):
+    decode = DECODERS[name]
+    read = read_records if name == "lean" else read_dicts
+    times = []
+    for _ in range(pages):
+        start = time.perf_counter()
+        read(decode(body))
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    page = decode(body)
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del page
+    return statistics.median(times), kept
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--pages", type=int, default=100)
+    add_arguments(parser)
+    options = parser.parse_args()
+
+    body = make_page(options)
+    print(f"page: {len(body) / 1024:.0f} KB, 200 tweets")
+    print(f"{'decoder':<8} {'ms/page':>8} {'tweets/s':>10} {'KB kept':>8}")
+    names = ["json", "orjson", "lean"] if orjson else ["json", "lean"]
+    for name in names:
+        seconds, kept = measure(name, body, options.pages)
+        print(f"{name:<8} {seconds * 1000:>8.2f} {200 / seconds:>10.0f} {kept / 1024:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
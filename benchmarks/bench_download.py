@@ -0,0 +1,132 @@
+"""Measure the throughput of Downloader against the mock twitter API.
+
+    python benchmarks/bench_download.py --latency 0.02 --settings thread:4 asyncio:64
+
+Every setting runs in its own process, so that the peak RSS is its own.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from mock_twitter import add_arguments, serve
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"mock server did not start on port {port}")
+
+
+def run(setting, options, results):
+    from download_twitter_resources import Downloader, metrics
+
+    engine, n = setting.split(":")
+    n = int(n)
+    dest = tempfile.mkdtemp(prefix="bench-")
+    try:
+        downloader = Downloader(
+            "key",
+            "secret",
+            thread_number=n,
+            engine=engine,
+            concurrency=n,
+            adaptive=options.adaptive,
+            connection_limit_per_host=options.connection_limit_per_host,
+            split_size=options.split_size * 1024 * 1024,
+            api_root=f"http://127.0.0.1:{options.port}",
+        )
+        start = time.time()
+        summary = downloader.download_images_of_user(
+            "mock",
+            dest,
+            limit=options.tweets,
+            include_video=options.video_percent > 0,
+            pipeline=options.pipeline,
+        )
+        downloader.d.join()
+        elapsed = time.time() - start
+    finally:
+        shutil.rmtree(dest)
+
+    results.put(
+        {
+            "setting": setting,
+            "seconds": round(elapsed, 3),
+            "tweets_per_second": round(summary["tweets"] / elapsed, 1),
+            "files_per_second": round(metrics.DOWNLOADED_FILES.total() / elapsed, 1),
+            "mb_per_second": round(
+                metrics.DOWNLOADED_BYTES.total() / elapsed / 1024 ** 2, 2
+            ),
+            "failed": metrics.FAILED_DOWNLOADS.total(),
+            # kilobytes on linux
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--settings",
+        nargs="+",
+        default=["thread:4", "thread:16", "asyncio:16", "asyncio:64"],
+        help="engine:n, n being --thread-number or --concurrency",
+    )
+    parser.add_argument("--port", type=int, default=8901)
+    parser.add_argument("--connection-limit-per-host", type=int, default=100)
+    parser.add_argument("--pipeline", action="store_true")
+    parser.add_argument(
+        "--split-size", type=int, default=0, help="split the media over this many MB"
+    )
+    parser.add_argument(
+        "--adaptive", action="store_true", help="start from n and adjust it"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    add_arguments(parser)
+    options = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    server = ctx.Process(target=serve, args=(options, options.port), daemon=True)
+    server.start()
+    rows = []
+    try:
+        wait_for_port(options.port)
+        for setting in options.settings:
+            results = ctx.Queue()
+            p = ctx.Process(target=run, args=(setting, options, results))
+            p.start()
+            p.join()
+            if p.exitcode:
+                raise RuntimeError(f"setting {setting} failed")
+            rows.append(results.get())
+    finally:
+        server.terminate()
+
+    columns = list(rows[0])
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(str(row[c]) for c in columns))
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Measure the startup cost of the command line tools.
+
+    python benchmarks/bench_startup.py --runs 20
+
+Reports the median wall time of `--help` and the cumulative import time
+of the package modules, as printed by `python -X importtime`.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    "download_twitter_resources.__main__",
+    "download_twitter_resources.downloader",
+]
+
+
+def import_time(module):
+    """Return the cumulative import time of module in microseconds."""
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    for line in p.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1])
+
+
+def wall_time(args):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-m", "download_twitter_resources", *args],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    for module in MODULES:
+        times = [import_time(module) for _ in range(args.runs)]
+        print(f"import {module}: {statistics.median(times) / 1000:.1f} ms")
+    times = [wall_time(["--help"]) for _ in range(args.runs)]
+    print(f"download-twitter-resources --help: {statistics.median(times) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""A local stand-in of the twitter API and media hosts, for benchmarks.
+
+    python benchmarks/mock_twitter.py --port 8900 --latency 0.05
+
+Every user has the same generated timeline. Media are served from
+/media/ on the same port, with bodies of a fixed size, and answer Range
+requests like the media hosts.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from aiohttp import web
+
+WINDOW = 15 * 60
+
+
+def make_tweet(id, options, base_url):
+    tweet = {
+        "id": id,
+        "id_str": str(id),
+        "text": f"tweet {id}",
+        "created_at": "Sat Nov 24 12:00:00 +0000 2018",
+        "user": {"id": 1, "name": "mock", "screen_name": "mock"},
+        "entities": {"hashtags": [], "urls": [], "user_mentions": []},
+    }
+    media = []
+    for i in range(options.media_per_tweet):
+        if id % 100 < options.video_percent:
+            media.append(
+                {
+                    "type": "video",
+                    "media_url": f"{base_url}/media/{id}-{i}.jpg",
+                    "video_info": {
+                        "variants": [
+                            {
+                                "bitrate": 832000,
+                                "content_type": "video/mp4",
+                                "url": f"{base_url}/media/{id}-{i}.mp4?tag=10",
+                            }
+                        ]
+                    },
+                }
+            )
+        else:
+            media.append(
+                {"type": "photo", "media_url": f"{base_url}/media/{id}-{i}.jpg"}
+            )
+    if media:
+        tweet["extended_entities"] = {"media": media}
+    return tweet
+
+
+def make_user(id):
+    return {"id": id, "id_str": str(id), "screen_name": f"user{id}", "name": f"User {id}"}
+
+
+class MockTwitter:
+    def __init__(self, options):
+        self.options = options
+        self.image = random.randbytes(options.image_size)
+        self.video = random.randbytes(options.video_size)
+        # the bodies are served from files, for the Range support of FileResponse
+        self.files = tempfile.TemporaryDirectory()
+        for name, body in [("image", self.image), ("video", self.video)]:
+            with open(os.path.join(self.files.name, name), "wb") as f:
+                f.write(body)
+        # endpoint -> (window end, calls made)
+        self.windows = {}
+        # the newest tweet has the largest id
+        self.newest = 10 ** 18 + options.tweets
+
+    def app(self):
+        app = web.Application(middlewares=[self.delay])
+        app.router.add_post("/oauth2/token", self.token)
+        app.router.add_get("/1.1/statuses/user_timeline.json", self.user_timeline)
+        app.router.add_get("/1.1/statuses/show.json", self.show)
+        app.router.add_get("/1.1/statuses/lookup.json", self.lookup_tweets)
+        app.router.add_get("/1.1/friends/list.json", self.users)
+        app.router.add_get("/1.1/followers/list.json", self.users)
+        app.router.add_get("/1.1/friends/ids.json", self.ids)
+        app.router.add_get("/1.1/followers/ids.json", self.ids)
+        app.router.add_get("/1.1/users/lookup.json", self.lookup)
+        app.router.add_get("/media/{name}", self.media)
+        return app
+
+    @web.middleware
+    async def delay(self, request, handler):
+        if self.options.latency:
+            await asyncio.sleep(self.options.latency)
+        return await handler(request)
+
+    def rate_limited(self, request, data):
+        endpoint = request.path
+        now = time.time()
+        end, calls = self.windows.get(endpoint, (0, 0))
+        if now >= end:
+            end, calls = now + self.options.window, 0
+        calls += 1
+        self.windows[endpoint] = end, calls
+        limit = self.options.rate_limit
+        headers = {
+            "x-rate-limit-limit": str(limit),
+            "x-rate-limit-remaining": str(max(0, limit - calls)),
+            "x-rate-limit-reset": str(int(end) + 1),
+        }
+        if calls > limit:
+            return web.json_response(
+                {"errors": [{"code": 88, "message": "Rate limit exceeded"}]},
+                status=429,
+                headers=headers,
+            )
+        return web.json_response(data, headers=headers)
+
+    def base_url(self, request):
+        return f"{request.scheme}://{request.host}"
+
+    async def token(self, request):
+        return web.json_response({"token_type": "bearer", "access_token": "mock"})
+
+    async def user_timeline(self, request):
+        q = request.query
+        count = min(int(q.get("count", 20)), 200)
+        top = min(int(q.get("max_id", self.newest)), self.newest)
+        bottom = max(int(q.get("since_id", 0)), self.newest - self.options.tweets)
+        ids = range(top, max(bottom, top - count), -1)
+        base_url = self.base_url(request)
+        tweets = [make_tweet(id, self.options, base_url) for id in ids]
+        return self.rate_limited(request, tweets)
+
+    async def show(self, request):
+        tweet = make_tweet(int(request.query["id"]), self.options, self.base_url(request))
+        return self.rate_limited(request, tweet)
+
+    async def lookup_tweets(self, request):
+        ids = [int(x) for x in request.query["id"].split(",")][:100]
+        base_url = self.base_url(request)
+        tweets = [make_tweet(id, self.options, base_url) for id in ids]
+        return self.rate_limited(request, tweets)
+
+    async def users(self, request):
+        q = request.query
+        count = min(int(q.get("count", 20)), 200)
+        cursor = max(int(q.get("cursor", -1)), 0)
+        end = min(cursor + count, self.options.users)
+        data = {
+            "users": [make_user(id) for id in range(cursor, end)],
+            "next_cursor": end if end < self.options.users else 0,
+        }
+        return self.rate_limited(request, data)
+
+    async def ids(self, request):
+        q = request.query
+        count = min(int(q.get("count", 5000)), 5000)
+        cursor = max(int(q.get("cursor", -1)), 0)
+        end = min(cursor + count, self.options.users)
+        data = {
+            "ids": list(range(cursor, end)),
+            "next_cursor": end if end < self.options.users else 0,
+        }
+        return self.rate_limited(request, data)
+
+    async def lookup(self, request):
+        ids = [int(x) for x in request.query["user_id"].split(",")][:100]
+        users = [make_user(id) for id in ids if id < self.options.users]
+        return self.rate_limited(request, users)
+
+    async def media(self, request):
+        if random.random() < self.options.error_rate:
+            return web.Response(status=503)
+        name = request.match_info["name"]
+        path = os.path.join(
+            self.files.name, "video" if name.endswith(".mp4") else "image"
+        )
+        return web.FileResponse(
+            path, headers={"Content-Type": "application/octet-stream"}
+        )
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--tweets", type=int, default=1000, help="tweets per timeline")
+    parser.add_argument("--media-per-tweet", type=int, default=1)
+    parser.add_argument(
+        "--video-percent", type=int, default=0, help="share of tweets with a video"
+    )
+    parser.add_argument("--image-size", type=int, default=100 * 1024)
+    parser.add_argument("--video-size", type=int, default=5 * 1024 * 1024)
+    parser.add_argument("--users", type=int, default=1000, help="friends/followers")
+    parser.add_argument(
+        "--rate-limit", type=int, default=900, help="calls per window and endpoint"
+    )
+    parser.add_argument("--window", type=int, default=WINDOW, help="seconds")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="share of media answered 503"
+    )
+
+
+def serve(options, port, host="127.0.0.1"):
+    web.run_app(MockTwitter(options).app(), host=host, port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock twitter API")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    options = parser.parse_args()
+    print(f"serving on http://127.0.0.1:{options.port}")
+    serve(options, options.port)
+
+
+if __name__ == "__main__":
+    main()
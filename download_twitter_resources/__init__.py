@@ -1,2 +1,10 @@
-from .downloader import Downloader
 version = "0.2.3"
+
+
+def __getattr__(name):
+    # import the downloader and its dependencies only when used
+    if name == "Downloader":
+        from .downloader import Downloader
+
+        return Downloader
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
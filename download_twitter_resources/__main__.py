@@ -3,32 +3,92 @@ import sys
 import argparse
 import json
 import re
-from . import Downloader
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from . import metrics
 from .exceptions import *
 
 
+# a tweet id, or a tweet url of any scheme or none
+TWEET_URL = re.compile(r"(?:\S*?/status/)?([0-9]{10,})(?:[/?#]\S*)?")
+
+
 def get_tweet_id(url):
     """
     https://twitter.com/KittenYang/status/1067790621375516673
     """
-    return re.match(r"(https://.+?status/)?([0-9]{10,})", url).group(2)
+    match = TWEET_URL.fullmatch(url)
+    if not match:
+        raise ValueError(f"not a tweet url: {url}")
+    return match.group(1)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Download all images uploaded by a twitter user you specify"
-    )
-    parser.add_argument(
-        "resource_id",
-        help="An ID of a twitter user. Also accept tweet url or tweet id.",
-    )
-    parser.add_argument("dest", help="Specify where to put images")
-    parser.add_argument(
-        "-c",
-        "--confidential",
-        help="a json file containing a key and a secret",
-        default=os.getenv("TWITTER_AUTH", os.path.expanduser("~/.twitter.json")),
-    )
+def is_tweet(resource_id):
+    return TWEET_URL.fullmatch(resource_id) is not None
+
+
+def is_user(resource_id):
+    # a screen name never holds a slash, unlike a mistyped url
+    return not is_tweet(resource_id) and "/" not in resource_id
+
+
+def shard_of(resource_id, count):
+    """Return the shard of a screen name or tweet url, the same on every host.
+
+    Any other line is sharded by itself, and skipped by the host crawling it.
+    """
+    match = TWEET_URL.fullmatch(resource_id)
+    if match:
+        key = match.group(1)
+    else:
+        key = resource_id.lstrip("@").lower()
+    return zlib.crc32(key.encode()) % count
+
+
+def shard_arg(value):
+    try:
+        index, count = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value}")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"expected 0 <= i < N, got {value}")
+    return index, count
+
+
+def read_batch(path):
+    """Return the screen names and tweet urls listed in a file, - for stdin."""
+    f = sys.stdin if path == "-" else open(path)
+    with f:
+        lines = [line.strip() for line in f]
+    return list(dict.fromkeys(x for x in lines if x and not x.startswith("#")))
+
+
+CREDENTIAL_KEYS = ["consumer_key", "consumer_secret", "access_token", "access_token_secret"]
+
+
+def load_confidentials(path):
+    """Return the credentials in a json file holding one or a list of them."""
+    if not path:
+        raise ConfidentialsNotSuppliedError(path)
+
+    with open(path) as f:
+        confidentials = json.loads(f.read())
+    if isinstance(confidentials, dict):
+        confidentials = [confidentials]
+
+    rv = []
+    for confidential in confidentials:
+        if "consumer_key" not in confidential or "consumer_secret" not in confidential:
+            raise ConfidentialsNotSuppliedError()
+        rv.append({k: confidential.get(k) for k in CREDENTIAL_KEYS})
+    if not rv:
+        raise ConfidentialsNotSuppliedError(path)
+    return rv
+
+
+def add_media_arguments(parser):
+    """Add the arguments choosing which media of a timeline to download."""
     parser.add_argument(
         "-s",
         "--size",
@@ -36,12 +96,6 @@ def main():
         default="orig",
         choices=["large", "medium", "small", "thumb", "orig"],
     )
-    parser.add_argument(
-        "--tweet",
-        help="indicate you gived a tweet url or tweet id",
-        default=False,
-        action="store_true",
-    )
     parser.add_argument(
         "--video", help="include video", default=False, action="store_true"
     )
@@ -55,36 +109,243 @@ def main():
     parser.add_argument(
         "--rts", help="save images contained in retweets", action="store_true"
     )
+    parser.add_argument(
+        "--pipeline",
+        help="fetch the next pages of the timeline while downloading",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        help="number of pages fetched ahead in pipeline mode",
+        default=2,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="only check tweets newer than the ones checked by the last run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--lean",
+        help="keep only the fields of the tweets which are used, to save CPU and memory",
+        action="store_true",
+    )
+
+
+def add_download_arguments(parser):
+    """Add the arguments shared by the commands downloading media."""
     parser.add_argument("--thread-number", type=int, default=4)
+    parser.add_argument(
+        "--engine",
+        help="download with a thread per transfer or with tasks in one event loop",
+        default="thread",
+        choices=["thread", "asyncio"],
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="maximum number of downloads in flight with the asyncio engine",
+        default=64,
+    )
+    parser.add_argument(
+        "--adaptive",
+        help="adjust the number of downloads in flight to the latency and throughput",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--min-concurrency",
+        type=int,
+        help="lowest number of downloads in flight with --adaptive",
+        default=1,
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        help="highest number of downloads in flight with --adaptive, default 4 times the initial one",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        type=float,
+        help="cap the downloads to this many MB per second",
+    )
+    parser.add_argument(
+        "--large-lanes",
+        type=int,
+        help="workers downloading the videos apart from the photos, 0 to share them",
+        default=2,
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="bytes read from a response at once while streaming it to disk",
+        default=64 * 1024,
+    )
+    parser.add_argument(
+        "--split-size",
+        type=int,
+        help="download files larger than this many MB as several byte ranges, 0 to disable",
+        default=0,
+    )
+    parser.add_argument(
+        "--segments",
+        type=int,
+        help="number of byte ranges fetched at the same time for a large file",
+        default=4,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        help="number of tries of each download before giving up",
+        default=5,
+    )
+    parser.add_argument(
+        "--dead-letter",
+        help="a file to append the urls which could not be downloaded to",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve metrics on http://127.0.0.1:PORT/metrics while running",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        help="write a summary of the metrics to this file when finished",
+    )
+    parser.add_argument(
+        "--connection-limit",
+        type=int,
+        help="total number of connections kept by each download session",
+        default=100,
+    )
+    parser.add_argument(
+        "--connection-limit-per-host",
+        type=int,
+        help="number of connections to the same host kept by each download session",
+        default=10,
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        help="seconds to keep an idle connection open",
+        default=30,
+    )
+    parser.add_argument(
+        "--dns-cache-ttl",
+        type=int,
+        help="seconds to cache resolved host names",
+        default=300,
+    )
     parser.add_argument(
         "--private", help="download private resources", action='store_true'
     )
+    parser.add_argument(
+        "--token-cache",
+        help="a file keeping the tokens between runs, default ~/.cache/download-twitter-resources/tokens.json",
+    )
+    parser.add_argument(
+        "--no-token-cache",
+        help="fetch new tokens instead of reusing those of earlier runs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--pace",
+        help="spread API calls evenly over each rate limit window",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--budgets",
+        help="a SQLite file sharing the rate limits with other processes on this host",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="skip downloaded media by the index of each directory instead of the files",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--journal",
+        help="keep the queued downloads and timeline cursors on disk to resume an interrupted run",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--store",
+        help="keep one copy of each media in this directory and link the saved files to it",
+    )
+    parser.add_argument(
+        "--store-link",
+        help="how to link the saved files to the store",
+        default="hard",
+        choices=["hard", "symlink"],
+    )
+
+
+def new_downloader(args):
+    from .auth import TokenCache
+    from .downloader import Downloader
+
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
+    credential, *credentials = load_confidentials(args.confidential)
+    return Downloader(
+        **credential,
+        thread_number=args.thread_number,
+        private=args.private,
+        connection_limit=args.connection_limit,
+        connection_limit_per_host=args.connection_limit_per_host,
+        keepalive_timeout=args.keepalive_timeout,
+        dns_cache_ttl=args.dns_cache_ttl,
+        engine=args.engine,
+        concurrency=args.concurrency,
+        chunk_size=args.chunk_size,
+        split_size=args.split_size * 1024 * 1024,
+        segments=args.segments,
+        pace=args.pace,
+        credentials=credentials,
+        manifest=args.manifest,
+        store=args.store,
+        store_link=args.store_link,
+        retries=args.retries,
+        dead_letter=args.dead_letter,
+        token_cache=None if args.no_token_cache else TokenCache(args.token_cache),
+        adaptive=args.adaptive,
+        min_concurrency=args.min_concurrency,
+        max_concurrency=args.max_concurrency,
+        bandwidth=args.max_bandwidth,
+        large_lanes=args.large_lanes,
+        budgets=args.budgets,
+        journal=args.journal,
+        lean=args.lean,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download all images uploaded by a twitter user you specify"
+    )
+    parser.add_argument(
+        "resource_id",
+        help="An ID of a twitter user. Also accept tweet url or tweet id.",
+    )
+    parser.add_argument("dest", help="Specify where to put images")
+    parser.add_argument(
+        "-c",
+        "--confidential",
+        help="a json file containing a key and a secret, or a list of them",
+        default=os.getenv("TWITTER_AUTH", os.path.expanduser("~/.twitter.json")),
+    )
+    parser.add_argument(
+        "--tweet",
+        help="indicate you gived a tweet url or tweet id",
+        default=False,
+        action="store_true",
+    )
+    add_media_arguments(parser)
+    add_download_arguments(parser)
     parser.add_argument("--keys-included", help="filter tweets", nargs='*')
     parser.add_argument("--keys-excluded", help="filter tweets", nargs='*')
     args = parser.parse_args()
     print(args)
 
-    if args.confidential:
-        with open(args.confidential) as f:
-            confidential = json.loads(f.read())
-        if "consumer_key" not in confidential or "consumer_secret" not in confidential:
-            raise ConfidentialsNotSuppliedError()
-
-        consumer_key = confidential["consumer_key"]
-        consumer_secret = confidential["consumer_secret"]
-        access_token = confidential["access_token"]
-        access_token_secret = confidential["access_token_secret"]
-    else:
-        raise ConfidentialsNotSuppliedError(args.confidential)
-
-    downloader = Downloader(
-        consumer_key,
-        consumer_secret,
-        access_token,
-        access_token_secret,
-        args.thread_number,
-        args.private,
-    )
+    downloader = new_downloader(args)
     if args.tweet:
         try:
             args.resource_id = get_tweet_id(args.resource_id)
@@ -92,6 +353,8 @@ def main():
             print(e)
             sys.exit(1)
 
+        # the download of an interrupted run is journaled as queued
+        downloader.resume_jobs(args.dest)
         tweet = downloader.get_tweet(args.resource_id)
         downloader.process_tweet(tweet, args.dest, args.size, args.video)
         downloader.d.join()
@@ -105,107 +368,289 @@ def main():
             args.video,
             keys_included=args.keys_included or [],
             keys_excluded=args.keys_excluded or [],
+            pipeline=args.pipeline,
+            prefetch=args.prefetch,
+            incremental=args.incremental,
         )
         downloader.d.join()
+    print('rate limits:', json.dumps(downloader.rate_limits))
+    if args.metrics_json:
+        metrics.write_summary(args.metrics_json)
     print('finished!')
 
 
-def main_followwing():
+def main_batch():
     parser = argparse.ArgumentParser(
-        description="Download following users of the given user name"
+        description="Download the images of many twitter users and tweets at once"
+    )
+    parser.add_argument(
+        "source",
+        help="a file listing screen names and tweet urls, one per line, - for stdin",
+    )
+    parser.add_argument(
+        "dest", help="Specify where to put images, a directory is made per user"
     )
-    parser.add_argument("user", help="user screen name")
     parser.add_argument(
         "-c",
         "--confidential",
-        help="a json file containing a key and a secret",
+        help="a json file containing a key and a secret, or a list of them",
         default=os.getenv("TWITTER_AUTH", os.path.expanduser("~/.twitter.json")),
     )
+    add_media_arguments(parser)
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        help="number of users crawled at the same time",
+        default=4,
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="split the list over this many processes, sharing the rate limits",
+        default=1,
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_arg,
+        help="crawl only the users and tweets of shard i of N, e.g. 0/4 on the first host",
+    )
+    add_download_arguments(parser)
     args = parser.parse_args()
     print(args)
 
-    if args.confidential:
-        with open(args.confidential) as f:
-            confidential = json.loads(f.read())
-        if "consumer_key" not in confidential or "consumer_secret" not in confidential:
-            raise ConfidentialsNotSuppliedError()
+    resources = read_batch(args.source)
+    if args.shard:
+        index, count = args.shard
+        resources = [x for x in resources if shard_of(x, count) == index]
+        print(f"shard {index}/{count}: {len(resources)} users and tweets")
 
-        consumer_key = confidential["consumer_key"]
-        consumer_secret = confidential["consumer_secret"]
-        access_token = confidential["access_token"]
-        access_token_secret = confidential["access_token_secret"]
+    if args.processes > 1:
+        # a coordinator, each process crawling a part of the list
+        args.budgets = args.budgets or os.path.join(args.dest, ".budgets.sqlite")
+        os.makedirs(args.dest, exist_ok=True)
+        parts = [resources[i :: args.processes] for i in range(args.processes)]
+        # the tweet downloads of an interrupted run, read before any process
+        # journals new ones and resumed by the first process only
+        jobs = []
+        if args.journal:
+            from .journal import Journal
+
+            journal = Journal(args.dest)
+            jobs = journal.pending()
+            journal.close()
+        summaries, rate_limits, stats = {}, [], []
+        with ProcessPoolExecutor(args.processes) as executor:
+            futures = [
+                executor.submit(crawl_shard, args, part, i, [] if i else jobs)
+                for i, part in enumerate(parts)
+            ]
+            for future in futures:
+                part_summaries, part_rate_limits, part_stats = future.result()
+                summaries.update(part_summaries)
+                rate_limits.append(part_rate_limits)
+                stats.append(part_stats)
+        if args.metrics_json:
+            with open(args.metrics_json, "w") as f:
+                json.dump({"processes": stats}, f, indent=2)
     else:
-        raise ConfidentialsNotSuppliedError(args.confidential)
+        summaries, rate_limits = crawl_batch(args, resources)
+        if args.metrics_json:
+            metrics.write_summary(args.metrics_json)
 
-    downloader = Downloader(
-        consumer_key,
-        consumer_secret,
-        access_token,
-        access_token_secret,
-    )
-    downloader.next_user_cursor = -1
-    users = []
-    while 1:
-        if downloader.next_user_cursor is None:
-            break
-        print('next_user_cursor', downloader.next_user_cursor)
-        us = downloader.get_following(args.user)
-        print('got users', len(us))
-        users += us
-    downloader.d.join()
-    print('got users:', len(users))
-    with open(f'{args.user}.following.json', 'w') as f:
-        json.dump(users, f, indent=2)
+    for resource_id in resources:
+        print(resource_id, json.dumps(summaries[resource_id]))
+    print('rate limits:', json.dumps(rate_limits))
     print('finished!')
 
 
-def main_friends():
+def crawl_shard(args, resources, index, jobs):
+    """Crawl a part of a batch in a process of the coordinator."""
+    if args.metrics_port:
+        # every process serves its own metrics
+        args.metrics_port += index
+    summaries, rate_limits = crawl_batch(args, resources, jobs)
+    return summaries, rate_limits, metrics.summary()
+
+
+def crawl_batch(args, resources, jobs=None):
+    """Download the media of the users and tweets of a batch.
+
+    Return the summary of each resource and the rate limits left.
+
+    Args:
+        jobs: The journaled tweet downloads to resume, all of them by default.
+    """
+    downloader = new_downloader(args)
+    # the downloads of the tweets of an interrupted run
+    downloader.resume_jobs(args.dest, jobs)
+
+    tweets = [x for x in resources if is_tweet(x)]
+    users = [x for x in resources if is_user(x)]
+    summaries = {}
+    for resource_id in resources:
+        if not is_tweet(resource_id) and not is_user(resource_id):
+            print(f"skipping {resource_id}: not a screen name or tweet url")
+            summaries[resource_id] = {"error": "not a screen name or tweet url"}
+
+    def crawl_tweets(urls):
+        # one statuses/lookup call per 100 tweets instead of one call each
+        d = downloader.fork()
+        start = time.time()
+        ids = {get_tweet_id(x): x for x in urls}
+        summaries = {x: {"tweets": 0, "media": 0} for x in urls}
+        for tweet in d.hydrate_tweets(list(ids)):
+            summary = summaries[ids[tweet["id_str"]]]
+            summary["tweets"] = 1
+            summary["media"] = d.process_tweet(tweet, args.dest, args.size, args.video)
+        seconds = round(time.time() - start, 1)
+        for summary in summaries.values():
+            summary["seconds"] = seconds
+        return summaries
+
+    def crawl(resource_id):
+        # share the auth and the download engine, but not the pagination
+        d = downloader.fork()
+        start = time.time()
+        user = resource_id.lstrip("@")
+        summary = d.download_images_of_user(
+            user,
+            os.path.join(args.dest, user),
+            args.size,
+            args.limit,
+            args.rts,
+            args.video,
+            pipeline=args.pipeline,
+            prefetch=args.prefetch,
+            incremental=args.incremental,
+        )
+        summary["seconds"] = round(time.time() - start, 1)
+        return {resource_id: summary}
+
+    with ThreadPoolExecutor(args.parallel) as executor:
+        futures = {executor.submit(crawl, x): [x] for x in users}
+        for i in range(0, len(tweets), 100):
+            chunk = tweets[i : i + 100]
+            futures[executor.submit(crawl_tweets, chunk)] = chunk
+        for future in as_completed(futures):
+            try:
+                summaries.update(future.result())
+            except Exception as e:
+                for resource_id in futures[future]:
+                    summaries[resource_id] = {"error": repr(e)}
+    downloader.d.join()
+    return summaries, downloader.rate_limits
+
+
+def main_manifest():
     parser = argparse.ArgumentParser(
-        description="Download friends of the given user name"
+        description="Rebuild the index of downloaded media from the files of directories"
     )
+    parser.add_argument("dest", nargs="+", help="directories to index")
+    args = parser.parse_args()
+
+    from .manifest import Manifest
+
+    for dest in args.dest:
+        manifest = Manifest(dest)
+        manifest.rebuild()
+        print(dest, len(manifest))
+        manifest.close()
+
+
+def export_users(kind, description):
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument("user", help="user screen name")
     parser.add_argument(
         "-c",
         "--confidential",
-        help="a json file containing a key and a secret",
+        help="a json file containing a key and a secret, or a list of them",
         default=os.getenv("TWITTER_AUTH", os.path.expanduser("~/.twitter.json")),
     )
+    parser.add_argument(
+        "-o", "--output", help=f"a NDJSON file, default USER.{kind}.ndjson"
+    )
+    parser.add_argument("--gzip", help="compress the output", action="store_true")
+    parser.add_argument(
+        "--fields", help="keep only these fields of each user", nargs="*"
+    )
+    parser.add_argument(
+        "--ids",
+        help="page through the ids endpoints, 5000 users per call",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--hydrate",
+        help="with --ids, look up the user objects of the ids, 100 per call",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--user-cache",
+        help="a file keeping the users looked up, default ~/.cache/download-twitter-resources/users.sqlite",
+    )
+    parser.add_argument(
+        "--no-user-cache",
+        help="look up every user again",
+        action="store_true",
+    )
     args = parser.parse_args()
     print(args)
 
-    if args.confidential:
-        with open(args.confidential) as f:
-            confidential = json.loads(f.read())
-        if "consumer_key" not in confidential or "consumer_secret" not in confidential:
-            raise ConfidentialsNotSuppliedError()
+    from .downloader import Downloader
+    from .export import UserExport
+    from .user_cache import UserCache
 
-        consumer_key = confidential["consumer_key"]
-        consumer_secret = confidential["consumer_secret"]
-        access_token = confidential["access_token"]
-        access_token_secret = confidential["access_token_secret"]
-    else:
-        raise ConfidentialsNotSuppliedError(args.confidential)
+    output = args.output or f"{args.user}.{kind}.ndjson"
+    if args.gzip and not output.endswith(".gz"):
+        output += ".gz"
+    export = UserExport(output, args.fields)
 
-    downloader = Downloader(
-        consumer_key,
-        consumer_secret,
-        access_token,
-        access_token_secret,
-    )
-    downloader.next_user_cursor = -1
-    users = []
+    credential, *credentials = load_confidentials(args.confidential)
+    downloader = Downloader(**credential, credentials=credentials)
+    if args.ids:
+        if kind == "following":
+            get_ids = downloader.get_following_ids
+        else:
+            get_ids = downloader.get_friend_ids
+        cache = None if args.no_user_cache else UserCache(args.user_cache)
+
+        def get_users(user):
+            # None when the page can not be written whole
+            ids = get_ids(user)
+            if args.hydrate:
+                return downloader.hydrate_users(ids, cache)
+            return [{"id": x} for x in ids]
+
+    elif kind == "following":
+        get_users = downloader.get_following
+    else:
+        get_users = downloader.get_friends
+    downloader.next_user_cursor = export.resume()
+    finished = False
     while 1:
         if downloader.next_user_cursor is None:
+            finished = True
             break
         print('next_user_cursor', downloader.next_user_cursor)
-        us = downloader.get_friends(args.user)
+        cursor = downloader.next_user_cursor
+        us = get_users(args.user)
+        if us is None or not us and downloader.next_user_cursor == cursor:
+            # the page is neither written nor checkpointed
+            print('stopped by an error, run again to resume')
+            break
         print('got users', len(us))
-        users += us
+        export.write(us, downloader.next_user_cursor)
     downloader.d.join()
-    print('got users:', len(users))
-    with open(f'{args.user}.friends.json', 'w') as f:
-        json.dump(users, f, indent=2)
-    print('finished!')
+    print('got users:', export.count)
+    if finished:
+        print('finished!')
+
+
+def main_followwing():
+    export_users("following", "Download following users of the given user name")
+
+
+def main_friends():
+    export_users("friends", "Download friends of the given user name")
 
 
 if __name__ == "__main__":
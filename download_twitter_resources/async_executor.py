@@ -1,11 +1,21 @@
 import os
 import asyncio
-from queue import Queue
-from threading import Thread
-import aiohttp
+import itertools
+import json
+import shutil
+from queue import PriorityQueue
+from threading import Thread, Event, Condition
 import logging
 import time
 
+from .exceptions import (
+    HTTPStatusError,
+    IncompleteDownloadError,
+    ResourceChangedError,
+)
+from .retry import RetryPolicy
+from . import metrics
+
 
 def run_async_func_in_loop(future):
     loop = asyncio.new_event_loop()
@@ -20,13 +30,28 @@ def run_in_thread(fn, *args, **kwargs):
     return thread
 
 
+# directories known to exist, to save a stat per file
+prepared_dirs = set()
+
+
 def prepare_dir(path):
     path = os.path.abspath(path)
     if not path.endswith("/"):
         path = os.path.dirname(path)
 
+    if path in prepared_dirs:
+        return
     if not os.path.isdir(path):
-        os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
+    prepared_dirs.add(path)
+
+
+# priority of the sentinel stopping a worker, after every job
+STOP = float("inf")
+
+# a smaller file is downloaded again instead of resumed, so that it needs
+# no sidecar describing its partial download
+RESUME_SIZE = 1024 * 1024
 
 
 def get_proxy():
@@ -37,49 +62,511 @@ def get_proxy():
                 return v
 
 
+def get_validator(response):
+    return response.headers.get("ETag") or response.headers.get("Last-Modified")
+
+
+def load_part_meta(dest):
+    """Return what is known about the partial download of dest."""
+    try:
+        with open(dest + ".part.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_part_meta(dest, meta):
+    with open(dest + ".part.json", "w") as f:
+        json.dump(meta, f)
+
+
+def remove_part_files(dest, segments=()):
+    for path in [dest + ".part.json", *segments]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
 class AsyncDownloader:
-    def __init__(self, maxsize=1000):
-        self.q = Queue(maxsize)
-        self.finish_q = Queue(maxsize)
+    def __init__(
+        self,
+        maxsize=1000,
+        connection_limit=100,
+        connection_limit_per_host=10,
+        keepalive_timeout=30,
+        dns_cache_ttl=300,
+        chunk_size=64 * 1024,
+        split_size=0,
+        segments=4,
+        retry=None,
+        dead_letter=None,
+        controller=None,
+        bandwidth=None,
+        large_lanes=0,
+    ):
+        # (priority, seq, job), the lowest priority first and the oldest
+        # job first within a priority
+        self.q = PriorityQueue(maxsize)
+        # the large jobs, served by large_lanes workers of their own so
+        # that they never hold up the small ones
+        self.large_q = PriorityQueue(maxsize)
+        self.large_lanes = large_lanes
+        self.seq = itertools.count()
+        # number of workers of each queue
+        self.workers = 0
+        self.large_workers = 0
+        # number of jobs added and not finished yet
+        self.pending = 0
+        self.idle = Condition()
         self.logger = logging.getLogger("async.downloader")
         self.threads = []
+        # connection pool settings of the session owned by each worker loop
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        # bytes read from the response body at once
+        self.chunk_size = chunk_size
+        # files larger than split_size are fetched as several byte ranges
+        self.split_size = split_size
+        self.segments = segments
+        self.proxy = get_proxy()
+        self.logger.debug(f"got proxy {self.proxy}")
+        self.retry = retry or RetryPolicy()
+        # (url, dest, reason) of the downloads given up, written to the
+        # file dead_letter by join()
+        self.failed = []
+        self.dead_letter = dead_letter
+        # an AdaptiveConcurrency choosing how many workers download, and
+        # a Bandwidth capping the bytes per second of them all
+        self.controller = controller
+        self.bandwidth = bandwidth
+        self.stopping = False
+        metrics.QUEUE_DEPTH.set_function(self.queue_depth)
+        metrics.CONCURRENCY.set_function(self.concurrency_limit)
 
     def start(self, n=4):
-        for _ in range(n):
-            thread = run_in_thread(run_async_func_in_loop, self.run())
+        if self.controller:
+            # the workers above the limit of the controller wait idle
+            n = self.controller.maximum
+        self.stopping = False
+        self.workers = n
+        self.large_workers = self.large_lanes
+        for i in range(n):
+            thread = run_in_thread(run_async_func_in_loop, self.run(i))
+            self.threads.append(thread)
+            self.logger.debug(thread)
+        for _ in range(self.large_lanes):
+            thread = run_in_thread(run_async_func_in_loop, self.run(large=True))
             self.threads.append(thread)
             self.logger.debug(thread)
 
+    def concurrency_limit(self):
+        if self.controller:
+            return self.controller.limit
+        return len(self.threads)
+
     def join(self):
-        while not self.q.empty() or not self.finish_q.empty():
-            self.logger.info('waiting to empty queue')
-            time.sleep(5)
+        """Wait until every job added is finished, then stop the workers."""
+        with self.idle:
+            if self.pending:
+                self.logger.info(f'waiting for {self.pending} downloads')
+            self.idle.wait_for(lambda: self.pending == 0)
+        self.stop()
+        self.write_failed()
+
+    def write_failed(self):
+        if not self.failed:
+            return
+        self.logger.warning(f"failed to download {len(self.failed)} urls")
+        if self.dead_letter:
+            with open(self.dead_letter, "a") as f:
+                for url, dest, reason in self.failed:
+                    f.write(f"{url}\t{dest}\t{reason}\n")
+            self.logger.warning(f"failed urls are written to {self.dead_letter}")
 
-    def add_url(self, url, dest):
-        self.q.put((url, dest))
+    def stop(self):
+        # stop the workers so that they close their sessions
+        self.stopping = True
+        for _ in range(self.workers):
+            self.q.put(self.stop_item())
+        for _ in range(self.large_workers):
+            self.large_q.put(self.stop_item())
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.workers = self.large_workers = 0
+
+    def add_url(
+        self, url, dest, callback=None, priority=0, large=False, errback=None
+    ):
+        """Queue a download of url to dest.
+
+        callback(url, dest) is called in an executor once dest is complete,
+        errback(url, dest, reason) once the download is given up.
+        The jobs of a lower priority are started first, the large ones
+        go to the large lanes if there are any.
+        """
+        self.begin_task()
+        self.lane(large).put(self.job_item(priority, url, dest, callback, errback))
         self.logger.debug(f"added ({url}, {dest})")
 
-    async def run(self):
-        while 1:
-            url, dest_path = self.q.get()
-            # add one running task
-            self.finish_q.put(url)
-            await self.download(url, dest_path)
-            # finished one task
-            self.finish_q.get()
-
-    async def download(self, url, dest):
+    def lane(self, large):
+        return self.large_q if large and self.large_lanes else self.q
+
+    def job_item(self, priority, *job):
+        return (priority, next(self.seq), job)
+
+    def stop_item(self):
+        return (STOP, next(self.seq), None)
+
+    def queue_depth(self):
+        return self.q.qsize() + self.large_q.qsize()
+
+    def begin_task(self):
+        with self.idle:
+            self.pending += 1
+
+    def task_done(self):
+        with self.idle:
+            self.pending -= 1
+            if self.pending == 0:
+                self.idle.notify_all()
+
+    def new_session(self):
+        """Create a session with a pooled connector.
+
+        Must be called inside the event loop which will use the session.
+        """
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            limit_per_host=self.connection_limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_cache_ttl,
+        )
+        return aiohttp.ClientSession(connector=connector)
+
+    async def run(self, index=0, large=False):
+        q = self.large_q if large else self.q
+        async with self.new_session() as session:
+            while 1:
+                while (
+                    self.controller
+                    and not large
+                    and index >= self.controller.limit
+                    and not self.stopping
+                ):
+                    await asyncio.sleep(0.1)
+                item = q.get()[-1]
+                if item is None:
+                    break
+
+                await self.process(session, *item)
+                self.task_done()
+
+    async def process(self, session, url, dest, callback=None, errback=None):
+        """Download url to dest, retrying by the policy. Never raises."""
+        attempt = 0
+        metrics.IN_FLIGHT.inc()
+        try:
+            while 1:
+                try:
+                    await self.download(session, url, dest)
+                    break
+                except Exception as e:
+                    if self.controller:
+                        self.controller.failure(e)
+                    attempt += 1
+                    if attempt >= self.retry.attempts or not self.retry.is_retryable(e):
+                        self.logger.warning(f"giving up {url}: {e!r}")
+                        self.failed.append((url, dest, repr(e)))
+                        metrics.FAILED_DOWNLOADS.inc()
+                        await self.call(errback, url, dest, repr(e))
+                        return
+                    delay = self.retry.delay(attempt, e)
+                    self.logger.info(f"retrying {url} in {delay:.1f}s: {e!r}")
+                    metrics.RETRIED_DOWNLOADS.inc()
+                    await asyncio.sleep(delay)
+        finally:
+            metrics.IN_FLIGHT.dec()
+
+        if self.controller:
+            self.controller.success()
+        metrics.DOWNLOADED_FILES.inc()
+        # dest is complete, a failing callback must not download it again
+        await self.call(callback, url, dest)
+
+    async def call(self, callback, *args):
+        """Run the callback of a job in an executor, logging its errors."""
+        if not callback:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, callback, *args)
+        except Exception:
+            self.logger.exception(f"callback of {args[0]} failed")
+
+    async def download(self, session, url, dest):
         prepare_dir(dest)
-        async with aiohttp.ClientSession() as session:
-            proxy = get_proxy()
-            self.logger.debug(f"got proxy {proxy}")
-            async with session.get(url, proxy=proxy) as response:
-                if response.status == 200:
-                    data = await response.read()
-                    with open(dest, "wb") as f:
-                        f.write(data)
-                        self.logger.info(f"{url} ==> {dest}")
-                else:
-                    self.logger.warning(
-                        f"url {url} reponse status code is {resonse.status}"
+        meta = load_part_meta(dest)
+        if meta.get("segments"):
+            await self.download_segments(session, url, dest, meta)
+        else:
+            await self.download_whole(session, url, dest, meta)
+        self.logger.info(f"{url} ==> {dest}")
+
+    async def download_whole(self, session, url, dest, meta):
+        # stream into a temporary file, so that an interrupted
+        # download never leaves a truncated file at dest
+        part = dest + ".part"
+        # without its sidecar a part may be of another version of the file
+        offset = os.path.getsize(part) if meta and os.path.exists(part) else 0
+        headers = {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            if meta.get("validator"):
+                headers["If-Range"] = meta["validator"]
+
+        sent = time.time()
+        async with session.get(url, proxy=self.proxy, headers=headers) as response:
+            self.record_latency(response, time.time() - sent)
+            if response.status == 206:
+                self.logger.info(f"resuming {url} from byte {offset}")
+            elif response.status == 200:
+                # a fresh start, or the resource changed since the last run
+                offset = 0
+                if self.should_split(response):
+                    meta = {
+                        "validator": get_validator(response),
+                        "length": response.content_length,
+                        "segments": self.segments,
+                    }
+            elif response.status == 416 and offset:
+                response.release()
+                if offset == meta.get("length"):
+                    # the previous run received every byte but did not rename
+                    return self.finish_part(part, dest)
+                # the part does not belong to the resource, start over
+                os.remove(part)
+                raise IncompleteDownloadError(url)
+            else:
+                raise HTTPStatusError(url, response)
+
+            if not meta.get("segments"):
+                length = response.content_length
+                if length is not None:
+                    length += offset
+                if length is None or length > RESUME_SIZE:
+                    save_part_meta(
+                        dest, {"validator": get_validator(response), "length": length}
                     )
+                with open(part, "ab" if offset else "wb") as f:
+                    await self.write_body(response, f)
+
+        if meta.get("segments"):
+            save_part_meta(dest, meta)
+            return await self.download_segments(session, url, dest, meta)
+
+        if length is not None and os.path.getsize(part) != length:
+            raise IncompleteDownloadError(url)
+        return self.finish_part(part, dest)
+
+    async def download_segments(self, session, url, dest, meta):
+        """Download a large file as several byte ranges at the same time."""
+        length, n = meta["length"], meta["segments"]
+        size = -(-length // n)
+        ranges = [(i, i * size, min(length, (i + 1) * size) - 1) for i in range(n)]
+        ranges = [x for x in ranges if x[1] <= x[2]]
+        segments = [f"{dest}.part.{i}" for i, start, end in ranges]
+        # let every segment stop before failing, they must not write
+        # into their files while a retry does
+        results = await asyncio.gather(
+            *(
+                self.download_segment(session, url, path, start, end, meta["validator"])
+                for path, (i, start, end) in zip(segments, ranges)
+            ),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                if isinstance(result, ResourceChangedError):
+                    remove_part_files(dest, segments)
+                raise result
+
+        part = dest + ".part"
+        with open(part, "wb") as f:
+            for segment in segments:
+                with open(segment, "rb") as s:
+                    shutil.copyfileobj(s, f, self.chunk_size)
+            f.flush()
+            os.fsync(f.fileno())
+        self.finish_part(part, dest)
+        remove_part_files(dest, segments)
+        return True
+
+    async def download_segment(self, session, url, path, start, end, validator):
+        have = os.path.getsize(path) if os.path.exists(path) else 0
+        if start + have > end:
+            return
+
+        headers = {"Range": f"bytes={start + have}-{end}"}
+        if validator:
+            headers["If-Range"] = validator
+        sent = time.time()
+        async with session.get(url, proxy=self.proxy, headers=headers) as response:
+            self.record_latency(response, time.time() - sent)
+            if response.status == 200:
+                raise ResourceChangedError(url)
+            if response.status != 206:
+                raise HTTPStatusError(url, response)
+            with open(path, "ab") as f:
+                await self.write_body(response, f)
+        if os.path.getsize(path) != end - start + 1:
+            raise IncompleteDownloadError(url)
+
+    def record_latency(self, response, latency):
+        metrics.DOWNLOAD_LATENCY.observe(latency, host=response.url.host)
+        if self.controller:
+            self.controller.sample(latency)
+
+    async def write_body(self, response, f):
+        host = response.url.host
+        async for chunk in response.content.iter_chunked(self.chunk_size):
+            if self.bandwidth:
+                await self.bandwidth.take(len(chunk))
+            f.write(chunk)
+            metrics.DOWNLOADED_BYTES.inc(len(chunk), host=host)
+            if self.controller:
+                self.controller.add_bytes(len(chunk))
+        f.flush()
+        os.fsync(f.fileno())
+
+    def should_split(self, response):
+        length = response.content_length
+        return bool(
+            self.split_size
+            and self.segments > 1
+            and length
+            and length > self.split_size
+            and response.headers.get("Accept-Ranges") == "bytes"
+        )
+
+    def finish_part(self, part, dest):
+        os.replace(part, dest)
+        remove_part_files(dest)
+        return True
+
+
+class ConcurrentDownloader(AsyncDownloader):
+    """Run many downloads concurrently inside a single event loop.
+
+    Jobs are fed through an asyncio.Queue and each one runs as a task,
+    the number of tasks in flight is bounded by a semaphore.
+    """
+
+    def __init__(self, maxsize=1000, concurrency=64, **kwargs):
+        super().__init__(maxsize, **kwargs)
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self.loop = None
+        self.aq = None
+        self.large_aq = None
+
+    def queue_depth(self):
+        if self.aq is None:
+            return 0
+        return self.aq.qsize() + self.large_aq.qsize()
+
+    def concurrency_limit(self):
+        if self.controller:
+            return self.controller.limit
+        return self.concurrency
+
+    def start(self, n=None):
+        ready = Event()
+        self.loop = asyncio.new_event_loop()
+        thread = run_in_thread(self.run_loop, ready)
+        self.threads.append(thread)
+        self.logger.debug(thread)
+        ready.wait()
+
+    def stop(self):
+        if self.loop is None:
+            return
+        stop = self.aq.put(self.stop_item())
+        asyncio.run_coroutine_threadsafe(stop, self.loop).result()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.loop.close()
+        self.loop = None
+
+    def add_url(
+        self, url, dest, callback=None, priority=0, large=False, errback=None
+    ):
+        self.begin_task()
+        # blocks the caller while the queue is full
+        item = self.job_item(priority, url, dest, callback, errback)
+        put = self.alane(large).put(item)
+        asyncio.run_coroutine_threadsafe(put, self.loop).result()
+        self.logger.debug(f"added ({url}, {dest})")
+
+    def alane(self, large):
+        return self.large_aq if large and self.large_lanes else self.aq
+
+    def run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.run(ready))
+
+    async def run(self, ready):
+        self.aq = asyncio.PriorityQueue(self.maxsize)
+        self.large_aq = asyncio.PriorityQueue(self.maxsize)
+        # set whenever a task finishes, the limit may change meanwhile
+        # so it is compared to the tasks running instead of a semaphore
+        slot = asyncio.Event()
+        tasks = set()
+
+        def finished(task):
+            tasks.discard(task)
+            slot.set()
+
+        async with self.new_session() as session:
+            lanes = [
+                asyncio.ensure_future(self.run_lane(session))
+                for _ in range(self.large_lanes)
+            ]
+            ready.set()
+            while 1:
+                # take the next job once it can start, so that the jobs
+                # added meanwhile are ordered by their priority too
+                while len(tasks) >= self.concurrency_limit():
+                    slot.clear()
+                    await slot.wait()
+                item = (await self.aq.get())[-1]
+                if item is None:
+                    break
+
+                task = asyncio.ensure_future(self.work(session, *item))
+                tasks.add(task)
+                task.add_done_callback(finished)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+            for _ in lanes:
+                await self.large_aq.put(self.stop_item())
+            await asyncio.gather(*lanes)
+
+    async def run_lane(self, session):
+        """Download the large jobs one at a time."""
+        while 1:
+            item = (await self.large_aq.get())[-1]
+            if item is None:
+                break
+            await self.work(session, *item)
+
+    async def work(self, session, url, dest, callback, errback):
+        try:
+            await self.process(session, url, dest, callback, errback)
+        finally:
+            self.task_done()
@@ -1,13 +1,108 @@
 import base64
+import contextlib
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 
-import requests
-from rauth import OAuth1Service
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from .exceptions import *
+from .ratelimit import RateLimiter, SharedRateLimiter
 
 lg = logging.getLogger("downloader")
 
+API_ROOT = "https://api.twitter.com"
+
+# error code of an invalid or expired token, a 401 without it is e.g. a
+# protected account the token may not see
+INVALID_TOKEN = 89
+
+
+def is_invalid_token(response):
+    """Whether a 401 response rejects the token itself."""
+    try:
+        errors = response.json().get("errors") or []
+    except (ValueError, AttributeError):
+        return False
+    return any(
+        isinstance(e, dict) and e.get("code") == INVALID_TOKEN for e in errors
+    )
+
+
+def cache_path(name):
+    cache = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(cache, "download-twitter-resources", name)
+
+
+class TokenCache:
+    """Tokens of earlier runs, kept in a json file only the user can read.
+
+    Args:
+        path: The json file, under ~/.cache by default.
+        ttl: Seconds a bearer token is reused before fetching a new one.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.path = path or cache_path("tokens.json")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self.load().get(key)
+        if entry and (entry["expires"] is None or entry["expires"] > time.time()):
+            return entry["value"]
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.locked():
+            data = self.load()
+            data[key] = {"value": value, "expires": expires}
+            self.save(data)
+
+    def delete(self, key):
+        with self.locked():
+            data = self.load()
+            if data.pop(key, None) is not None:
+                self.save(data)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold the cache against the other threads and processes."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            # the cache file itself is replaced, so lock a file beside it
+            fd = os.open(self.path + ".lock", os.O_WRONLY | os.O_CREAT, 0o600)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def save(self, data):
+        # mkstemp creates the file readable by the user only
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
 
 class TwitterAuth:
     def __init__(
@@ -17,16 +112,51 @@ class TwitterAuth:
         access_token=None,
         access_token_secret=None,
         private=False,
+        api_root=API_ROOT,
+        cache=None,
     ):
+        self.api_root = api_root
         self.consumer_key = consumer_key
         self.consumer_secret = consumer_secret
+        self.access_token = access_token
+        self.access_token_secret = access_token_secret
         self.private = private
+        self.cache = cache
         if not private:
-            self.bearer_token = self.bearer(consumer_key, consumer_secret)
+            self.bearer_token = self.get_bearer_token()
             lg.info("Bearer token is " + self.bearer_token)
         else:
             self.bearer_token = None
 
+    def cache_key(self, kind):
+        return f"{kind}:{self.api_root}:{self.consumer_key}"
+
+    def get_bearer_token(self):
+        """Return the cached bearer token, or receive a new one."""
+        token = self.cache and self.cache.get(self.cache_key("bearer"))
+        if not token:
+            token = self.bearer(self.consumer_key, self.consumer_secret)
+            if self.cache:
+                self.cache.set(self.cache_key("bearer"), token, self.cache.ttl)
+        return token
+
+    def renew(self):
+        """Forget the tokens rejected by the API and get new ones.
+
+        An access token is only given by the PIN flow, which needs a user,
+        so TokenRejectedError is raised in private mode instead.
+        """
+        if self.private:
+            if self.cache:
+                self.cache.delete(self.cache_key("oauth1"))
+            raise TokenRejectedError(
+                "the access token was rejected, remove it from the config"
+                " and run again to authorize a new one"
+            )
+        if self.cache:
+            self.cache.delete(self.cache_key("bearer"))
+        self.bearer_token = self.get_bearer_token()
+
     def bearer(self, key, secret):
         """Receive the bearer token and return it.
 
@@ -39,7 +169,7 @@ class TwitterAuth:
         credential = base64.b64encode(
             bytes("{}:{}".format(key, secret), "utf-8")
         ).decode()
-        url = "https://api.twitter.com/oauth2/token"
+        url = f"{self.api_root}/oauth2/token"
         headers = {
             "Authorization": "Basic {}".format(credential),
             "Content-Type": "application/x-www-form-urlencoded;charset=UTF-8",
@@ -47,6 +177,8 @@ class TwitterAuth:
         payload = {"grant_type": "client_credentials"}
 
         # post the request
+        import requests
+
         r = requests.post(url, headers=headers, params=payload)
 
         # check the response
@@ -57,10 +189,34 @@ class TwitterAuth:
 
     def session(self):
         if self.private:
-            return self.oauth1a_session(
+            if not self.access_token and self.cache:
+                cached = self.cache.get(self.cache_key("oauth1"))
+                if cached:
+                    self.access_token, self.access_token_secret = cached
+            if self.access_token and self.access_token_secret:
+                from rauth import OAuth1Session
+
+                return OAuth1Session(
+                    self.consumer_key,
+                    self.consumer_secret,
+                    self.access_token,
+                    self.access_token_secret,
+                )
+
+            session = self.oauth1a_session(
                 self.consumer_key, self.consumer_secret, callback='oob'
             )
+            self.access_token = session.access_token
+            self.access_token_secret = session.access_token_secret
+            if self.cache:
+                self.cache.set(
+                    self.cache_key("oauth1"),
+                    [self.access_token, self.access_token_secret],
+                )
+            return session
         else:
+            import requests
+
             headers = {"Authorization": "Bearer {}".format(self.bearer_token)}
             s = requests.Session()
             s.headers = headers
@@ -72,14 +228,16 @@ class TwitterAuth:
         consumer_secret,  # , access_token=None, access_token_secret=None
         callback=None,
     ):
+        from rauth import OAuth1Service
+
         twitter = OAuth1Service(
             name='twitter',
             consumer_key=consumer_key,
             consumer_secret=consumer_secret,
-            request_token_url='https://api.twitter.com/oauth/request_token',
-            access_token_url='https://api.twitter.com/oauth/access_token',
-            authorize_url='https://api.twitter.com/oauth/authorize',
-            base_url='https://api.twitter.com/1.1/',
+            request_token_url=f'{self.api_root}/oauth/request_token',
+            access_token_url=f'{self.api_root}/oauth/access_token',
+            authorize_url=f'{self.api_root}/oauth/authorize',
+            base_url=f'{self.api_root}/1.1/',
         )
 
         request_token, request_token_secret = twitter.get_request_token(
@@ -96,3 +254,60 @@ class TwitterAuth:
             data={'oauth_verifier': pin},
         )
         return session
+
+
+class Token:
+    def __init__(self, name, auth, pace=False, budgets=None):
+        self.name = name
+        self.auth = auth
+        self.session = auth.session()
+        if budgets:
+            key = auth.cache_key("budget")
+            self.limiter = SharedRateLimiter(budgets, key, pace=pace)
+        else:
+            self.limiter = RateLimiter(pace=pace)
+
+    def renew(self):
+        self.auth.renew()
+        self.session = self.auth.session()
+
+
+class TokenPool:
+    """Spread API calls over the rate limits of several credentials.
+
+    Args:
+        budgets: A SQLite file sharing the rate limits with other processes.
+    """
+
+    def __init__(self, auths, pace=False, budgets=None):
+        self.tokens = [
+            Token(str(i), auth, pace, budgets) for i, auth in enumerate(auths)
+        ]
+        self.lock = threading.Lock()
+
+    def acquire(self, endpoint):
+        """Return the token with the most budget left for endpoint.
+
+        Blocks until one of the tokens may call endpoint again.
+        """
+        while 1:
+            with self.lock:
+                ranked = sorted(
+                    self.tokens,
+                    key=lambda t: t.limiter.available(endpoint),
+                    reverse=True,
+                )
+                delays = []
+                for token in ranked:
+                    # checks and spends the budget in one transaction, as
+                    # other processes may spend it meanwhile
+                    delay = token.limiter.reserve(endpoint)
+                    if delay <= 0:
+                        return token
+                    delays.append(delay)
+                delay = min(delays)
+            lg.info(f"waiting {delay:.1f}s for the rate limit of {endpoint}")
+            time.sleep(delay)
+
+    def state(self):
+        return {t.name: t.limiter.state() for t in self.tokens}
@@ -1,22 +1,56 @@
+import copy
 import logging
 import os
 import json
-import subprocess
-
-from download_twitter_resources.auth import TwitterAuth, lg
-from .async_executor import AsyncDownloader, prepare_dir
+import shutil
+import threading
+import time
+from queue import Queue
+
+from download_twitter_resources.auth import (
+    API_ROOT,
+    TwitterAuth,
+    TokenPool,
+    is_invalid_token,
+    lg,
+)
+from .async_executor import (
+    AsyncDownloader,
+    ConcurrentDownloader,
+    prepare_dir,
+    run_in_thread,
+)
 from .exceptions import *
+from .records import Tweet, loads, media_of
+from .retry import RetryPolicy
+from .throttle import AdaptiveConcurrency, Bandwidth
+from . import metrics
 
 DEBUG = os.getenv("DEBUG")
 logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
 
+# download order of the media types, the lowest first
+MEDIA_PRIORITIES = {"photo": 0, "animated_gif": 1, "video": 2}
+
+# the newest tweet ID checked of each user, kept in the download directory
+SINCE_IDS = ".since_ids.json"
+
 
-def get_terminal_size():
-    rows, columns = subprocess.check_output(['stty', 'size']).split()
-    return int(rows), int(columns)
+def load_since_ids(save_dest):
+    try:
+        with open(os.path.join(save_dest, SINCE_IDS)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-rows, columns = get_terminal_size()
+def save_since_id(save_dest, user, since):
+    since_ids = load_since_ids(save_dest)
+    since_ids[user] = since
+    path = os.path.join(save_dest, SINCE_IDS)
+    with open(path + ".tmp", "w") as f:
+        json.dump(since_ids, f)
+    os.replace(path + ".tmp", path)
 
 
 class Downloader:
@@ -28,23 +62,212 @@ class Downloader:
         access_token_secret=None,
         thread_number=4,
         private=False,
+        connection_limit=100,
+        connection_limit_per_host=10,
+        keepalive_timeout=30,
+        dns_cache_ttl=300,
+        engine="thread",
+        concurrency=64,
+        chunk_size=64 * 1024,
+        split_size=0,
+        segments=4,
+        pace=False,
+        credentials=(),
+        manifest=False,
+        store=None,
+        store_link="hard",
+        retries=5,
+        dead_letter=None,
+        api_root=API_ROOT,
+        token_cache=None,
+        adaptive=False,
+        min_concurrency=1,
+        max_concurrency=None,
+        bandwidth=None,
+        large_lanes=0,
+        budgets=None,
+        journal=False,
+        lean=False,
     ):
+        """
+        Args:
+            credentials: Dicts of more keys to spread the API calls over,
+                with the same fields as the arguments of TwitterAuth.
+            manifest: Decide which media were downloaded by the manifest
+                of the directory instead of looking for the files.
+            store: A directory keeping one copy of each media, which the
+                saved files are linked to.
+            store_link: Link the saved files with "hard" links or "symlink".
+            retries: Number of tries of each download.
+            dead_letter: A file to append the urls given up to.
+            api_root: Where the API is served, e.g. by a mock for benchmarks.
+            token_cache: A TokenCache reusing the tokens of earlier runs.
+            adaptive: Let the number of downloads run at the same time
+                follow the latency and throughput, starting from
+                thread_number or concurrency, between min_concurrency and
+                max_concurrency.
+            bandwidth: Cap the downloads to this many MB per second.
+            large_lanes: Number of workers downloading the videos, apart
+                from those downloading the photos.
+            budgets: A SQLite file sharing the rate limit budgets with the
+                other processes crawling with the same credentials.
+            journal: Keep the queued downloads and the timeline cursors
+                in the journal of each directory, resuming them first.
+            lean: Keep only the fields of the tweets which are used, as
+                Tweet records instead of dicts.
+        """
         self.auth = TwitterAuth(
             consumer_key,
             consumer_secret,
             access_token,
             access_token_secret,
             private=private,
+            api_root=api_root,
+            cache=token_cache,
         )
-        self.session = self.auth.session()
+        auths = [self.auth] + [
+            TwitterAuth(private=private, api_root=api_root, cache=token_cache, **kwargs)
+            for kwargs in credentials
+        ]
+        self.api_root = api_root
+        self.tokens = TokenPool(auths, pace=pace, budgets=budgets)
+        self.session = self.tokens.tokens[0].session
         self.last_tweet = None
         self.next_user_cursor = -1
         self.count = 0
-        self.d = AsyncDownloader(100)
-        self.d.start(thread_number)
+        self.use_manifest = manifest
+        self.manifests = {}
+        self.manifests_lock = threading.Lock()
+        self.use_journal = journal
+        self.lean = lean
+        self.journals = {}
+        self.store = None
+        if store:
+            from .store import MediaStore
+
+            self.store = MediaStore(store, store_link)
+        pool = dict(
+            connection_limit=connection_limit,
+            connection_limit_per_host=connection_limit_per_host,
+            keepalive_timeout=keepalive_timeout,
+            dns_cache_ttl=dns_cache_ttl,
+            chunk_size=chunk_size,
+            split_size=split_size,
+            segments=segments,
+            retry=RetryPolicy(retries),
+            dead_letter=dead_letter,
+            large_lanes=large_lanes,
+        )
+        if adaptive:
+            initial = concurrency if engine == "asyncio" else thread_number
+            pool["controller"] = AdaptiveConcurrency(
+                initial, min_concurrency, max_concurrency or 4 * initial
+            )
+        if bandwidth:
+            pool["bandwidth"] = Bandwidth(bandwidth * 2**20)
+        if engine == "asyncio":
+            self.d = ConcurrentDownloader(100, concurrency=concurrency, **pool)
+            self.d.start()
+        else:
+            self.d = AsyncDownloader(100, **pool)
+            self.d.start(thread_number)
+
+    def fork(self):
+        """Return a downloader with its own pagination state, which shares
+        the auth, the tokens and the download engine with this one."""
+        other = copy.copy(self)
+        other.last_tweet = None
+        other.next_user_cursor = -1
+        other.count = 0
+        return other
+
+    def get_manifest(self, path):
+        """Return the manifest of the directory path, opening it once."""
+        path = os.path.abspath(path)
+        with self.manifests_lock:
+            if path not in self.manifests:
+                from .manifest import Manifest
+
+                self.manifests[path] = Manifest(path)
+            return self.manifests[path]
+
+    def get_journal(self, path):
+        """Return the journal of the directory path, opening it once."""
+        path = os.path.abspath(path)
+        with self.manifests_lock:
+            if path not in self.journals:
+                from .journal import Journal
+
+                self.journals[path] = Journal(path)
+            return self.journals[path]
+
+    def resume_jobs(self, path, jobs=None):
+        """Queue again the downloads journaled into path by an earlier run.
 
-    def get_friends(self, screen_name, cursor=None, count=200):
-        url = "https://api.twitter.com/1.1/friends/list.json"
+        Args:
+            jobs: The pending jobs of the journal when they were read
+                beforehand, e.g. by the coordinator of several processes.
+        """
+        if not self.use_journal:
+            return 0
+        if jobs is None:
+            jobs = self.get_journal(path).pending()
+        if jobs:
+            lg.info(f"resuming {len(jobs)} downloads journaled in {path}")
+        for url, dest, priority, large in jobs:
+            self.queue_media(url, dest, path, priority, large)
+        return len(jobs)
+
+    def load_tweets(self, response):
+        """Decode a list of tweets, into Tweet records in lean mode."""
+        tweets = loads(response.content)
+        if self.lean:
+            return [Tweet.from_dict(x) for x in tweets]
+        return tweets
+
+    @property
+    def rate_limits(self):
+        """The known budget of each API endpoint, by token."""
+        return self.tokens.state()
+
+    def api_get(self, endpoint, params):
+        """Call an endpoint of the v1.1 API within its rate limit.
+
+        The call goes to the token with the most budget left for endpoint,
+        a token answered with 429 is skipped until its window resets, and
+        a token answered with 401 for being invalid or expired is renewed
+        once.
+        """
+        url = f"{self.api_root}/1.1/{endpoint}.json"
+        renewed = set()
+        while 1:
+            token = self.tokens.acquire(endpoint)
+            start = time.time()
+            r = token.session.get(url, params=params)
+            metrics.API_LATENCY.observe(time.time() - start, endpoint=endpoint)
+            metrics.API_CALLS.inc(endpoint=endpoint, status=r.status_code)
+            if r.status_code == 401 and token not in renewed and is_invalid_token(r):
+                lg.warning(f"Token {token.name} was rejected, renewing it")
+                renewed.add(token)
+                token.renew()
+                continue
+            if r.status_code != 429:
+                token.limiter.update(endpoint, r.headers)
+                remaining = token.limiter.budget(endpoint).remaining
+                if remaining is not None:
+                    metrics.RATE_LIMIT_REMAINING.set(
+                        remaining, token=token.name, endpoint=endpoint
+                    )
+                return r
+            lg.warning(f"Rate limit of {endpoint} exceeded for token {token.name}")
+            token.limiter.exhaust(endpoint, r.headers)
+
+    def get_cursored(self, endpoint, key, screen_name, cursor=None, count=200):
+        """Return the items under key of a page of a cursored endpoint.
+
+        The page starts at cursor, or else where the last page ended, and
+        next_user_cursor is set to where it ends, None after the last page.
+        """
         payload = {
             "screen_name": screen_name,
             "count": count,
@@ -52,12 +275,11 @@ class Downloader:
         cs = cursor or self.next_user_cursor
         if cs:
             payload["cursor"] = cs
-        r = self.session.get(url, params=payload)
+        r = self.api_get(endpoint, payload)
         if r.status_code == 200:
             res = r.json()
-            users = res['users']
             self.next_user_cursor = res.get('next_cursor', None) or None  # maybe 0
-            return users
+            return res[key]
         else:
             lg.error(
                 f"An error occurred with the request, status code was {r.status_code}"
@@ -65,27 +287,56 @@ class Downloader:
             lg.error(r.text)
             return []
 
+    def get_friends(self, screen_name, cursor=None, count=200):
+        return self.get_cursored("friends/list", "users", screen_name, cursor, count)
+
     def get_following(self, screen_name, cursor=None, count=200):
-        url = "https://api.twitter.com/1.1/followers/list.json"
-        payload = {
-            "screen_name": screen_name,
-            "count": count,
-        }
-        cs = cursor or self.next_user_cursor
-        if cs:
-            payload["cursor"] = cs
-        r = self.session.get(url, params=payload)
+        return self.get_cursored("followers/list", "users", screen_name, cursor, count)
+
+    def get_friend_ids(self, screen_name, cursor=None, count=5000):
+        return self.get_cursored("friends/ids", "ids", screen_name, cursor, count)
+
+    def get_following_ids(self, screen_name, cursor=None, count=5000):
+        return self.get_cursored("followers/ids", "ids", screen_name, cursor, count)
+
+    def lookup_users(self, ids):
+        """Return the user objects of at most 100 user IDs, None on an error."""
+        endpoint = "users/lookup"
+        payload = {"user_id": ",".join(str(x) for x in ids)}
+        r = self.api_get(endpoint, payload)
         if r.status_code == 200:
-            res = r.json()
-            users = res['users']
-            self.next_user_cursor = res.get('next_cursor', None) or None  # maybe 0
-            return users
+            return r.json()
+        elif r.status_code == 404:
+            # none of the users exists anymore
+            return []
         else:
             lg.error(
                 f"An error occurred with the request, status code was {r.status_code}"
             )
             lg.error(r.text)
-            return []
+            return None
+
+    def hydrate_users(self, ids, cache=None):
+        """Return the user objects of ids, looking up 100 at a time.
+
+        None is returned if a lookup failed, the users looked up meanwhile
+        are kept in the cache.
+
+        Args:
+            ids: User IDs.
+            cache: A UserCache, the users in it are not looked up again.
+        """
+        known = cache.get_many(ids) if cache else {}
+        missing = [x for x in ids if x not in known]
+        for i in range(0, len(missing), 100):
+            users = self.lookup_users(missing[i : i + 100])
+            if users is None:
+                return None
+            if cache:
+                cache.put_many(users)
+            known.update((user["id"], user) for user in users)
+        # suspended or deleted users are not returned
+        return [known[x] for x in ids if x in known]
 
     def download_images_of_user(
         self,
@@ -97,6 +348,9 @@ class Downloader:
         include_video=False,
         keys_included=[],
         keys_excluded=[],
+        pipeline=False,
+        prefetch=2,
+        incremental=False,
     ):
         """Download and save images that user uploaded.
 
@@ -105,6 +359,13 @@ class Downloader:
             save_dest: The directory where images will be saved.
             size: Which size of images to download.
             rts: Whether to include retweets or not.
+            pipeline: Fetch the next pages in a thread while processing.
+            prefetch: How many pages the fetching thread may run ahead.
+            incremental: Only check the tweets newer than the newest one
+                checked by the last complete run into save_dest.
+
+        Returns:
+            A dict with the number of tweets checked and media found.
         """
 
         if not os.path.isdir(save_dest):
@@ -113,27 +374,110 @@ class Downloader:
             except Exception as e:
                 raise InvalidDownloadPathError(str(e))
 
+        since = load_since_ids(save_dest).get(user) if incremental else None
         num_tweets_checked = 0
-        tweets = self.get_tweets(user, self.last_tweet, limit, rts)
+        num_media = 0
+        journal = None
+        if self.use_journal:
+            journal = self.get_journal(save_dest)
+            # the downloads found by an interrupted run go first
+            num_media = self.resume_jobs(save_dest)
+            cursor = journal.cursor(user)
+            if cursor:
+                self.last_tweet, num_tweets_checked, newest = cursor
+                lg.info(f"resuming the timeline of {user} after {self.last_tweet}")
+        if pipeline:
+            pages = Queue(prefetch)
+            stop = threading.Event()
+            run_in_thread(
+                self.fetch_pages,
+                pages,
+                user,
+                limit,
+                rts,
+                since,
+                num_tweets_checked,
+                stop,
+            )
+            next_page = pages.get
+            tweets = next_page()
+        else:
+            next_page = lambda: self.get_tweets(
+                user, self.last_tweet, limit, rts, since
+            )
+            tweets = self.get_tweets(user, self.last_tweet, limit, rts, since)
+        if not num_tweets_checked:
+            newest = tweets[0]["id"] if tweets else None
+
         if not tweets:
             lg.info("Got an empty list of tweets")
 
-        while len(tweets) > 0 and num_tweets_checked < limit:
-            for tweet in tweets:
-                self.process_tweet(
-                    tweet,
-                    save_dest,
-                    include_video=include_video,
-                    keys_included=keys_included,
-                    keys_excluded=keys_excluded,
-                )
-                num_tweets_checked += 1
-
-            tweets = self.get_tweets(user, self.last_tweet, count=limit)
+        try:
+            while tweets and num_tweets_checked < limit:
+                for tweet in tweets:
+                    num_media += self.process_tweet(
+                        tweet,
+                        save_dest,
+                        include_video=include_video,
+                        keys_included=keys_included,
+                        keys_excluded=keys_excluded,
+                    )
+                    num_tweets_checked += 1
+
+                if journal:
+                    journal.save_cursor(
+                        user, self.last_tweet, num_tweets_checked, newest
+                    )
+                tweets = next_page()
+        finally:
+            if pipeline:
+                # stop the fetching thread, taking the pages it is putting
+                stop.set()
+                while tweets:
+                    tweets = pages.get()
+
+        reached_limit = num_tweets_checked >= limit
+
+        # None is a page which could not be fetched, [] the end of the timeline
+        if not reached_limit and tweets is None:
+            lg.error(f"stopped checking the timeline of {user} after an error")
+            return {"tweets": num_tweets_checked, "media": num_media}
 
         lg.info(
             f"no more tweets or the number of tweets checked reach the limit {limit}"
         )
+        if journal:
+            journal.clear_cursor(user)
+        if incremental and newest:
+            # the whole range since the last run was checked, or as much
+            # of it as the limit allows
+            save_since_id(save_dest, user, newest)
+        return {"tweets": num_tweets_checked, "media": num_media}
+
+    def fetch_pages(self, pages, user, limit, rts, since=None, checked=0, stop=None):
+        """Put pages of user's timeline into the queue pages, then [] at
+        its end or the limit, or None if a page could not be fetched.
+
+        Args:
+            checked: Number of tweets checked before, by an earlier run.
+            stop: An Event stopping the fetching after the current page.
+        """
+        start = self.last_tweet
+        num_tweets_fetched = checked
+        last = None
+        try:
+            while num_tweets_fetched < limit and not (stop and stop.is_set()):
+                tweets = self.get_tweets(user, start, limit, rts, since)
+                if not tweets:
+                    last = tweets
+                    break
+                pages.put(tweets)
+                num_tweets_fetched += len(tweets)
+                start = tweets[-1]["id"]
+            else:
+                last = []
+        finally:
+            pages.put(last)
 
     def process_tweet(
         self,
@@ -154,40 +498,48 @@ class Downloader:
 
             if any(x in text for x in keys_included):
                 print(tweet['created_at'], tweet['id'])
-                print(json.dumps(tweet, ensure_ascii=False))
-                print('-' * columns)
+                if isinstance(tweet, Tweet):
+                    print(json.dumps(tweet.as_dict(), ensure_ascii=False))
+                else:
+                    print(json.dumps(tweet, ensure_ascii=False))
+                print('-' * shutil.get_terminal_size().columns)
                 images = self.extract_media_list(tweet, include_video)
                 return len(images)
             return 0
         else:
             # save the image
-            images = self.extract_media_list(tweet, include_video)
-            for i, image in enumerate(images, 1):
-                self.save_media(image, save_dest, f"{id_str}-{i}", size)
-            return len(images)
+            media = self.extract_media(tweet, include_video)
+            for i, (kind, url) in enumerate(media, 1):
+                self.save_media(url, save_dest, f"{id_str}-{i}", size, kind)
+            return len(media)
 
-    def get_tweets(self, user, start=None, count=200, rts=False):
+    def get_tweets(self, user, start=None, count=200, rts=False, since=None):
         """Download user's tweets and return them as a list.
 
+        Returns [] at the end of the timeline, or None if the request failed.
+
         Args:
             user: User ID.
             start: Tweet ID.
             rts: Whether to include retweets or not.
+            since: Only return tweets newer than this tweet ID.
         """
 
         # setup
-        url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+        endpoint = "statuses/user_timeline"
         payload = {"screen_name": user, "count": count, "include_rts": rts}
         if start:
             payload["max_id"] = start
+        if since:
+            payload["since_id"] = since
 
         # get the request
-        r = self.session.get(url, params=payload)
+        r = self.api_get(endpoint, payload)
 
         # check the response
         if r.status_code == 200:
-            tweets = r.json()
-            if len(tweets) == 1:
+            tweets = self.load_tweets(r)
+            if start and len(tweets) == 1:
                 return []
             else:
                 lg.info("Got " + str(len(tweets)) + " tweets")
@@ -197,7 +549,7 @@ class Downloader:
                 f"An error occurred with the request, status code was {r.status_code}"
             )
             lg.error(r.text)
-            return []
+            return None
 
     def get_tweet(self, id):
         """Download single tweet
@@ -206,11 +558,11 @@ class Downloader:
             id: Tweet ID.
         """
 
-        url = "https://api.twitter.com/1.1/statuses/show.json"
+        endpoint = "statuses/show"
         payload = {"id": id, "include_entities": "true"}
 
         # get the request
-        r = self.session.get(url, params=payload)
+        r = self.api_get(endpoint, payload)
 
         # check the response
         if r.status_code == 200:
@@ -224,36 +576,53 @@ class Downloader:
             lg.error(r.text)
             return None
 
+    def lookup_tweets(self, ids):
+        """Return the tweets of at most 100 tweet IDs.
+
+        Deleted and protected tweets are left out.
+        """
+        endpoint = "statuses/lookup"
+        payload = {"id": ",".join(str(x) for x in ids), "include_entities": "true"}
+        r = self.api_get(endpoint, payload)
+        if r.status_code == 200:
+            tweets = self.load_tweets(r)
+            lg.info(f"Got {len(tweets)} of {len(ids)} tweets")
+            return tweets
+        else:
+            lg.error(
+                f"An error occurred with the request, status code was {r.status_code}"
+            )
+            lg.error(r.text)
+            return []
+
+    def hydrate_tweets(self, ids):
+        """Yield the tweets of ids, looking up 100 at a time.
+
+        Args:
+            ids: Tweet IDs.
+        """
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), 100):
+            yield from self.lookup_tweets(ids[i : i + 100])
+
     def extract_media_list(self, tweet, include_video):
         """Return the url of the image embedded in tweet.
 
         Args:
             tweet: A dict object representing a tweet.
         """
-        rv = []
-
-        extended = tweet.get("extended_entities")
-        if not extended:
-            return rv
-
-        if "media" in extended:
-            for x in extended["media"]:
-                if x["type"] == "photo":
-                    url = x["media_url"]
-                    rv.append(url)
-                elif x["type"] in ["video", "animated_gif"]:
-                    if include_video:
-                        variants = x["video_info"]["variants"]
-                        variants.sort(key=lambda x: x.get("bitrate", 0))
-                        url = variants[-1]["url"].rsplit("?tag")[0]
-                        rv.append(url)
-                # else:
-                #     import pdb
-                #
-                #     pdb.set_trace()
-        return rv
-
-    def save_media(self, image, path, name, size="large"):
+        return [url for kind, url in self.extract_media(tweet, include_video)]
+
+    def extract_media(self, tweet, include_video):
+        """Return the (type, url) of the media embedded in tweet.
+
+        Args:
+            tweet: A dict object representing a tweet, or a Tweet.
+        """
+        media = tweet.media if isinstance(tweet, Tweet) else media_of(tweet)
+        return [x for x in media if include_video or x.type == "photo"]
+
+    def save_media(self, image, path, name, size="large", kind="photo"):
         """Download and save an image to path.
 
         Args:
@@ -261,6 +630,7 @@ class Downloader:
             path: The directory where the image will be saved.
             name: It is used for naming the image.
             size: Which size of images to download.
+            kind: The media type, photos are downloaded before videos.
         """
         if image:
             # image's path with a new name
@@ -272,8 +642,42 @@ class Downloader:
                 real_url = image
 
             # save the image in the specified directory (or don't)
-            prepare_dir(save_dest)
-            if not (os.path.exists(save_dest)):
-                self.d.add_url(real_url, save_dest)
+            if self.use_manifest:
+                downloaded = name + ext in self.get_manifest(path)
             else:
+                prepare_dir(save_dest)
+                downloaded = os.path.exists(save_dest)
+
+            priority = MEDIA_PRIORITIES.get(kind, 0)
+            large = kind == "video"
+            if downloaded:
                 lg.info(f"Skipping downloaded {image}")
+            elif self.use_manifest and self.get_manifest(path).link(
+                real_url, save_dest
+            ):
+                # saved under another name before, e.g. by a retweet
+                lg.info(f"Linking saved {image}")
+            elif self.use_journal and not self.get_journal(path).add(
+                real_url, save_dest, priority, large
+            ):
+                lg.info(f"Skipping queued {image}")
+            else:
+                self.queue_media(real_url, save_dest, path, priority, large)
+
+    def queue_media(self, url, dest, path, priority=0, large=False):
+        """Hand the download of url to dest over to the store or the engine."""
+        callbacks = []
+        if self.use_manifest:
+            callbacks.append(self.get_manifest(path).record)
+        if self.use_journal:
+            callbacks.append(self.get_journal(path).done)
+
+        def callback(url, dest):
+            for f in callbacks:
+                f(url, dest)
+
+        job = dict(priority=priority, large=large)
+        if self.store:
+            self.store.fetch(self.d, url, dest, callback, **job)
+        else:
+            self.d.add_url(url, dest, callback if callbacks else None, **job)
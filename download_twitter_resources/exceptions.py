@@ -10,5 +10,30 @@ class BearerTokenNotFetchedError(Error):
     '''Couldn't fetch the bearer token.'''
 
 
+class TokenRejectedError(Error):
+    '''The API rejected an access token which can't be renewed unattended.'''
+
+
 class InvalidDownloadPathError(Error):
     '''Download path must be a directory.'''
+
+
+class DownloadError(Error):
+    '''A media couldn't be downloaded.'''
+
+
+class HTTPStatusError(DownloadError):
+    '''The media server answered with an unexpected status code.'''
+
+    def __init__(self, url, response):
+        super().__init__(f"url {url} response status code is {response.status}")
+        self.status = response.status
+        self.retry_after = response.headers.get("Retry-After")
+
+
+class IncompleteDownloadError(DownloadError):
+    '''The connection closed before the whole media was received.'''
+
+
+class ResourceChangedError(DownloadError):
+    '''The media changed while it was downloaded in parts.'''
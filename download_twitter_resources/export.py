@@ -0,0 +1,89 @@
+import gzip
+import json
+import logging
+import os
+
+lg = logging.getLogger("export")
+
+
+class UserExport:
+    """Write pages of users to a NDJSON file as they arrive.
+
+    After each page the cursor of the next one and the size of the file
+    are saved to path + ".cursor", so that an interrupted crawl resumes
+    from the last page written. A path ending in .gz is compressed, one
+    gzip member per page.
+
+    Args:
+        path: The NDJSON file.
+        fields: Keep only these fields of each user.
+    """
+
+    def __init__(self, path, fields=None):
+        self.path = path
+        self.checkpoint_path = path + ".cursor"
+        self.fields = fields
+        self.count = 0
+
+    def resume(self):
+        """Return the cursor to start from, -1 for the first page."""
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            checkpoint = None
+
+        if checkpoint is not None:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                size = -1
+            if size < checkpoint["offset"]:
+                # truncating would pad the output with NUL bytes
+                lg.warning(f"{self.path} is missing or shorter, starting over")
+                checkpoint = None
+
+        if checkpoint is None:
+            open(self.path, "wb").close()
+            return -1
+
+        # drop what was written after the checkpoint
+        with open(self.path, "ab") as f:
+            f.truncate(checkpoint["offset"])
+        self.count = checkpoint["count"]
+        lg.info(f"resuming {self.path} after {self.count} users")
+        return checkpoint["cursor"]
+
+    def project(self, user):
+        if not self.fields:
+            return user
+        return {k: user[k] for k in self.fields if k in user}
+
+    def open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "at", encoding="utf-8")
+        return open(self.path, "a", encoding="utf-8")
+
+    def write(self, users, next_cursor):
+        with self.open() as f:
+            for user in users:
+                f.write(json.dumps(self.project(user), ensure_ascii=False) + "\n")
+        with open(self.path, "rb") as f:
+            os.fsync(f.fileno())
+        self.count += len(users)
+
+        if not next_cursor:
+            # finished, the next run starts over
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+            return
+
+        checkpoint = {
+            "cursor": next_cursor,
+            "offset": os.path.getsize(self.path),
+            "count": self.count,
+        }
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, self.checkpoint_path)
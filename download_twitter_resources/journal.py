@@ -0,0 +1,95 @@
+import logging
+import os
+import sqlite3
+import threading
+
+lg = logging.getLogger("journal")
+
+JOURNAL = ".journal.sqlite"
+
+
+class Journal:
+    """Downloads queued into a directory, and how far the timelines saved
+    there were crawled.
+
+    The journal is a SQLite file in the directory. A download is removed
+    once finished and a cursor once its timeline is crawled to the end, so
+    that a run killed meanwhile is resumed instead of crawled again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, JOURNAL)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs"
+            " (name TEXT PRIMARY KEY, url TEXT, priority INTEGER, large INTEGER)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cursors (user TEXT PRIMARY KEY,"
+            " last_tweet INTEGER, checked INTEGER, newest INTEGER)"
+        )
+        self.names = {name for name, in self.db.execute("SELECT name FROM jobs")}
+
+    def name(self, dest):
+        return os.path.relpath(dest, self.directory)
+
+    def add(self, url, dest, priority=0, large=False):
+        """Journal the download of url to dest, False if it is already."""
+        name = self.name(dest)
+        with self.lock:
+            if name in self.names:
+                return False
+            self.db.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, ?)", (name, url, priority, large)
+            )
+            self.db.commit()
+            self.names.add(name)
+        return True
+
+    def done(self, url, dest):
+        """Remove the finished download dest, used as the callback of a download."""
+        name = self.name(dest)
+        with self.lock:
+            self.db.execute("DELETE FROM jobs WHERE name = ?", (name,))
+            self.db.commit()
+            self.names.discard(name)
+
+    def pending(self):
+        """Return the (url, dest, priority, large) of the unfinished downloads."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT url, name, priority, large FROM jobs ORDER BY rowid"
+            ).fetchall()
+        return [
+            (url, os.path.join(self.directory, name), priority, bool(large))
+            for url, name, priority, large in rows
+        ]
+
+    def cursor(self, user):
+        """Return the (last_tweet, checked, newest) of an unfinished timeline."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT last_tweet, checked, newest FROM cursors WHERE user = ?",
+                (user,),
+            ).fetchone()
+
+    def save_cursor(self, user, last_tweet, checked, newest):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)",
+                (user, last_tweet, checked, newest),
+            )
+            self.db.commit()
+
+    def clear_cursor(self, user):
+        with self.lock:
+            self.db.execute("DELETE FROM cursors WHERE user = ?", (user,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
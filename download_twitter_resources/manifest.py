@@ -0,0 +1,135 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+
+lg = logging.getLogger("manifest")
+
+MANIFEST = ".manifest.sqlite"
+
+# temporary files of unfinished downloads
+PART = re.compile(r"\.part(\.json|\.[0-9]+)?$")
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Index of the media saved in a directory.
+
+    The index is a SQLite file in the directory, loaded into memory when
+    opened, so that checking whether a file was downloaded is a lookup
+    instead of a stat.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST)
+        self.lock = threading.Lock()
+        exists = os.path.exists(self.path)
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS media"
+            " (name TEXT PRIMARY KEY, url TEXT, size INTEGER, sha1 TEXT)"
+        )
+        self.names = {}
+        self.urls = {}
+        if exists:
+            self.load()
+        else:
+            # index what earlier runs downloaded without a manifest
+            self.rebuild(digest=False)
+
+    def load(self):
+        rows = self.db.execute("SELECT name, url, size, sha1 FROM media").fetchall()
+        self.names = {name: (url, size, sha1) for name, url, size, sha1 in rows}
+        self.urls = {url: name for name, url, size, sha1 in rows if url}
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def has_url(self, url):
+        return url in self.urls
+
+    def link(self, url, dest):
+        """Make dest a hard link, or else a copy, of the file saved from url.
+
+        Return False if no file of url is known.
+        """
+        with self.lock:
+            name = self.urls.get(url)
+            if name is None:
+                return False
+            _, size, sha1 = self.names[name]
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return False
+        if os.path.lexists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+        self.add(os.path.relpath(dest, self.directory), url, size, sha1)
+        return True
+
+    def add(self, name, url, size, sha1):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)",
+                (name, url, size, sha1),
+            )
+            self.db.commit()
+            self.names[name] = (url, size, sha1)
+            if url:
+                self.urls[url] = name
+
+    def record(self, url, dest):
+        """Add the downloaded file dest, used as the callback of a download."""
+        self.add(
+            os.path.relpath(dest, self.directory),
+            url,
+            os.path.getsize(dest),
+            file_digest(dest),
+        )
+
+    def rebuild(self, digest=True):
+        """Index the files found in the directory again.
+
+        The urls already known are kept for the files still present.
+        """
+        rows = []
+        for entry in os.scandir(self.directory):
+            if (
+                not entry.is_file()
+                or entry.name.startswith(".")
+                or PART.search(entry.name)
+            ):
+                continue
+            url = self.names.get(entry.name, (None,))[0]
+            sha1 = file_digest(entry.path) if digest else None
+            rows.append((entry.name, url, entry.stat().st_size, sha1))
+
+        with self.lock:
+            self.db.execute("DELETE FROM media")
+            self.db.executemany("INSERT INTO media VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+            self.load()
+        lg.info(f"indexed {len(rows)} files in {self.directory}")
+
+    def close(self):
+        self.db.close()
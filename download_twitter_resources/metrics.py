@@ -0,0 +1,218 @@
+"""Counters of the work done, exposed in the Prometheus text format.
+
+The metrics are module level, like those of prometheus_client, so that
+every part of the package can update them without passing them around.
+"""
+import json
+import logging
+import threading
+import time
+
+lg = logging.getLogger("metrics")
+
+# upper bounds of the latency buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[k]) for k in self.labels)
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.samples():
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+    def summary(self):
+        return {",".join(key) or "": value for key, value in self.samples()}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        return sum(v for k, v in self.samples())
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.function = None
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        """Read the value from function() whenever the gauge is collected."""
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            return [((), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(BUCKETS), 0, 0]
+            buckets, _, _ = h = self.values[key]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            h[1] += 1
+            h[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        names = self.labels + ("le",)
+        for key, (buckets, count, total) in self.samples():
+            for bound, n in zip(BUCKETS, buckets):
+                le = "+Inf" if bound == float("inf") else bound
+                labels = format_labels(names, key + (le,))
+                lines.append(f"{self.name}_bucket{labels} {n}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_count{labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+        return lines
+
+    def summary(self):
+        return {
+            ",".join(key): {
+                "count": count,
+                "sum": round(total, 3),
+                "avg": round(total / count, 3) if count else None,
+            }
+            for key, (buckets, count, total) in self.samples()
+        }
+
+
+REGISTRY = []
+STARTED = time.time()
+
+API_CALLS = Counter(
+    "twitter_api_calls_total", "Calls of the API", ["endpoint", "status"]
+)
+API_LATENCY = Histogram(
+    "twitter_api_latency_seconds", "Latency of the API calls", ["endpoint"]
+)
+RATE_LIMIT_REMAINING = Gauge(
+    "twitter_rate_limit_remaining",
+    "Calls left in the rate limit window",
+    ["token", "endpoint"],
+)
+QUEUE_DEPTH = Gauge("download_queue_depth", "Jobs waiting for a download worker")
+IN_FLIGHT = Gauge("downloads_in_flight", "Downloads running")
+CONCURRENCY = Gauge("download_concurrency", "Downloads allowed at the same time")
+DOWNLOADED_FILES = Counter("downloaded_files_total", "Files downloaded")
+DOWNLOADED_BYTES = Counter(
+    "downloaded_bytes_total", "Bytes received from the media hosts", ["host"]
+)
+FAILED_DOWNLOADS = Counter("failed_downloads_total", "Downloads given up")
+RETRIED_DOWNLOADS = Counter("retried_downloads_total", "Downloads tried again")
+DOWNLOAD_LATENCY = Histogram(
+    "download_latency_seconds",
+    "Time to the response headers of the media hosts",
+    ["host"],
+)
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """Return the metrics as a dict, with the average throughput."""
+    elapsed = time.time() - STARTED
+    rv = {
+        "elapsed_seconds": round(elapsed, 3),
+        "files_per_second": round(DOWNLOADED_FILES.total() / elapsed, 3),
+        "mb_per_second": round(DOWNLOADED_BYTES.total() / elapsed / 1024 ** 2, 3),
+    }
+    for metric in REGISTRY:
+        rv[metric.name] = metric.summary()
+    return rv
+
+
+def write_summary(path):
+    with open(path, "w") as f:
+        json.dump(summary(), f, indent=2)
+
+
+def handle_metrics(handler):
+    if handler.path == "/metrics":
+        body, content_type = render(), "text/plain; version=0.0.4"
+    elif handler.path == "/metrics.json":
+        body, content_type = json.dumps(summary()), "application/json"
+    else:
+        handler.send_error(404)
+        return
+    body = body.encode()
+    handler.send_response(200)
+    handler.send_header("Content-Type", content_type)
+    handler.send_header("Content-Length", str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def start_http_server(port, host="127.0.0.1"):
+    """Serve /metrics and /metrics.json from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        do_GET = handle_metrics
+
+        def log_message(self, format, *args):
+            lg.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    lg.info(f"serving metrics on http://{host}:{port}/metrics")
+    return server
+
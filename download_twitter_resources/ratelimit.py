@@ -0,0 +1,182 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+lg = logging.getLogger("ratelimit")
+
+# length of a rate limit window of the v1.1 API
+WINDOW = 15 * 60
+
+
+class EndpointBudget:
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+        self.next_call = 0
+
+    def state(self):
+        return {"limit": self.limit, "remaining": self.remaining, "reset": self.reset}
+
+
+class RateLimiter:
+    """Schedule API calls by the x-rate-limit headers of each endpoint.
+
+    Args:
+        pace: Spread the remaining calls over the rest of the window,
+            instead of spending them at once and sleeping until the reset.
+    """
+
+    def __init__(self, pace=False):
+        self.pace = pace
+        self.budgets = {}
+        self.lock = threading.Lock()
+
+    def budget(self, endpoint):
+        if endpoint not in self.budgets:
+            self.budgets[endpoint] = EndpointBudget()
+        return self.budgets[endpoint]
+
+    def reserve(self, endpoint):
+        """Reserve a call and return 0, or return the seconds to wait."""
+        with self.lock:
+            delay = self.delay(endpoint)
+            if delay <= 0:
+                self.take(endpoint)
+            return delay
+
+    def delay(self, endpoint):
+        b = self.budget(endpoint)
+        now = time.time()
+        if b.remaining is None or now >= b.reset:
+            # nothing known about the current window
+            return 0
+        if b.remaining <= 0:
+            return b.reset - now + 1
+        if self.pace and now < b.next_call:
+            return b.next_call - now
+        return 0
+
+    def available(self, endpoint):
+        """Number of calls left in the current window, inf if unknown."""
+        b = self.budget(endpoint)
+        if b.remaining is None or time.time() >= b.reset:
+            return float("inf")
+        return b.remaining
+
+    def take(self, endpoint):
+        b = self.budget(endpoint)
+        now = time.time()
+        if b.remaining is None or now >= b.reset:
+            return
+        b.remaining -= 1
+        if self.pace:
+            b.next_call = now + (b.reset - now) / (b.remaining + 1)
+
+    def update(self, endpoint, headers):
+        """Record the budget reported by the response headers of a call."""
+        try:
+            limit = int(headers["x-rate-limit-limit"])
+            remaining = int(headers["x-rate-limit-remaining"])
+            reset = int(headers["x-rate-limit-reset"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            b = self.budget(endpoint)
+            b.limit, b.remaining, b.reset = limit, remaining, reset
+
+    def exhaust(self, endpoint, headers):
+        """Mark the budget of endpoint as spent after a 429 response."""
+        self.update(endpoint, headers)
+        with self.lock:
+            b = self.budget(endpoint)
+            b.remaining = 0
+            if b.reset <= time.time():
+                b.reset = time.time() + WINDOW
+
+    def state(self):
+        with self.lock:
+            return {k: v.state() for k, v in self.budgets.items()}
+
+
+class SharedRateLimiter(RateLimiter):
+    """A RateLimiter keeping the budgets in a SQLite file, so that the
+    processes calling the API with the same token share them.
+
+    Args:
+        path: The SQLite file.
+        token: The name of the token in the file, the same in every process.
+    """
+
+    def __init__(self, path, token, pace=False):
+        super().__init__(pace)
+        self.token = token
+        # reentrant, the transactions call budget()
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS budgets (token TEXT, endpoint TEXT,"
+            " lim INTEGER, remaining INTEGER, reset REAL, next_call REAL,"
+            " PRIMARY KEY (token, endpoint))"
+        )
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.db.in_transaction:
+                yield
+                return
+            # lock the file for writing before reading the budget
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def budget(self, endpoint):
+        b = super().budget(endpoint)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT lim, remaining, reset, next_call FROM budgets"
+                " WHERE token = ? AND endpoint = ?",
+                (self.token, endpoint),
+            ).fetchone()
+        if row:
+            b.limit, b.remaining, b.reset, b.next_call = row
+        return b
+
+    def save(self, endpoint):
+        b = self.budgets[endpoint]
+        self.db.execute(
+            "INSERT OR REPLACE INTO budgets VALUES (?, ?, ?, ?, ?, ?)",
+            (self.token, endpoint, b.limit, b.remaining, b.reset, b.next_call),
+        )
+
+    def reserve(self, endpoint):
+        with self.transaction():
+            delay = self.delay(endpoint)
+            if delay <= 0:
+                self.take(endpoint)
+            return delay
+
+    def take(self, endpoint):
+        with self.transaction():
+            super().take(endpoint)
+            self.save(endpoint)
+
+    def update(self, endpoint, headers):
+        with self.transaction():
+            super().update(endpoint, headers)
+            self.save(endpoint)
+
+    def exhaust(self, endpoint, headers):
+        with self.transaction():
+            super().exhaust(endpoint, headers)
+            self.save(endpoint)
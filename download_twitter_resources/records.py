@@ -0,0 +1,84 @@
+"""Lean records of the tweets of a timeline.
+
+A timeline page holds up to 200 full tweets, of which only a few fields
+are read. Tweet keeps those, so that the pages waiting to be processed
+do not hold the whole objects, and pages are decoded with orjson when it
+is installed.
+"""
+import json
+from typing import NamedTuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(data):
+    """Decode the JSON body of a response, with orjson if installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Media(NamedTuple):
+    type: str
+    url: str
+
+
+def media_of(tweet):
+    """Return the Media embedded in a tweet dict, the best video variant
+    of each video and animated_gif."""
+    rv = []
+    extended = tweet.get("extended_entities")
+    if not extended:
+        return rv
+
+    for x in extended.get("media", []):
+        if x["type"] == "photo":
+            rv.append(Media(x["type"], x["media_url"]))
+        elif x["type"] in ["video", "animated_gif"]:
+            variants = x["video_info"]["variants"]
+            best = sorted(variants, key=lambda v: v.get("bitrate", 0))[-1]
+            rv.append(Media(x["type"], best["url"].rsplit("?tag")[0]))
+    return rv
+
+
+class Tweet:
+    """The fields of a tweet read by Downloader.process_tweet.
+
+    Like a dict, tweet["id"] reads a field.
+    """
+
+    __slots__ = ("id", "id_str", "text", "created_at", "media")
+
+    def __init__(self, id, id_str, text, created_at, media):
+        self.id = id
+        self.id_str = id_str
+        self.text = text
+        self.created_at = created_at
+        self.media = media
+
+    @classmethod
+    def from_dict(cls, tweet):
+        return cls(
+            tweet["id"],
+            tweet["id_str"],
+            tweet.get("full_text") or tweet.get("text", ""),
+            tweet.get("created_at"),
+            media_of(tweet),
+        )
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def as_dict(self):
+        rv = {k: getattr(self, k) for k in self.__slots__}
+        rv["media"] = [m._asdict() for m in self.media]
+        return rv
+
+    def __repr__(self):
+        return f"Tweet(id={self.id!r}, media={self.media!r})"
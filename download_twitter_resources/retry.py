@@ -0,0 +1,49 @@
+import asyncio
+import random
+
+from .exceptions import HTTPStatusError, IncompleteDownloadError, ResourceChangedError
+
+# statuses worth another try, the others (404, 403, 410...) are permanent
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class RetryPolicy:
+    """Decide whether and when a failed download is tried again.
+
+    Args:
+        attempts: Number of tries of a download, including the first one.
+        backoff: Seconds to wait after the first failure, doubled after
+            each next one.
+        max_backoff: Upper bound of a wait.
+    """
+
+    def __init__(self, attempts=5, backoff=1.0, max_backoff=60.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def is_retryable(self, error):
+        import aiohttp
+
+        if isinstance(error, HTTPStatusError):
+            return error.status in RETRY_STATUSES or error.status >= 500
+        return isinstance(
+            error,
+            (
+                IncompleteDownloadError,
+                ResourceChangedError,
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                ConnectionError,
+            ),
+        )
+
+    def delay(self, attempt, error=None):
+        """Seconds to wait before the next try, after attempt failed tries."""
+        # full jitter, so that workers failing together do not retry together
+        cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        delay = random.uniform(0, cap)
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
@@ -0,0 +1,190 @@
+import functools
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from .async_executor import prepare_dir
+from .manifest import PART
+
+lg = logging.getLogger("store")
+
+# the downloads of the media claimed by the processes sharing a store
+CLAIMS = ".claims.sqlite"
+
+# a claim of a media not stored after this long is taken over
+CLAIM_TIMEOUT = 60 * 60
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def media_key(url):
+    """Return the name of the media of url, which twitter never reuses.
+
+    http://pbs.twimg.com/media/foo.jpg:orig -> foo-orig.jpg
+    """
+    name = os.path.basename(urlparse(url).path)
+    name, _, size = name.partition(":")
+    if size:
+        root, ext = os.path.splitext(name)
+        name = f"{root}-{size}{ext}"
+    return name
+
+
+class MediaStore:
+    """Keep a single copy of each media, linked from every path it is saved to.
+
+    Files are stored under their media key, in subdirectories named by
+    the first byte of the key's hash. The processes sharing a store claim
+    the media they download in a SQLite file, the others wait for the
+    claimant to link their paths.
+
+    Args:
+        directory: Where the files are stored.
+        link: "hard" or "symlink".
+    """
+
+    def __init__(self, directory, link="hard"):
+        self.directory = os.path.abspath(directory)
+        self.link_type = link
+        self.lock = threading.Lock()
+        # waiting (dest, callback) of the media being downloaded
+        self.pending = {}
+        self.keys = set()
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = sqlite3.connect(
+            os.path.join(self.directory, CLAIMS),
+            timeout=60,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS claims"
+            " (key TEXT PRIMARY KEY, stored INTEGER, pid INTEGER, claimed REAL)"
+        )
+        self.db.execute("CREATE TABLE IF NOT EXISTS waiting (key TEXT, dest TEXT)")
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                self.keys.update(
+                    x.name for x in os.scandir(shard.path) if not PART.search(x.name)
+                )
+
+    def path(self, key):
+        shard = hashlib.sha1(key.encode()).hexdigest()[:2]
+        return os.path.join(self.directory, shard, key)
+
+    def fetch(self, downloader, url, dest, callback=None, **kwargs):
+        """Link dest to the stored copy of url, downloading it first if needed.
+
+        callback(url, dest) is called once dest is linked, kwargs are
+        passed to add_url.
+        """
+        key = media_key(url)
+        with self.lock:
+            if key in self.pending:
+                self.pending[key].append((dest, callback))
+                return
+            stored = key in self.keys
+            if not stored:
+                claim = self.claim(key, dest)
+                if claim == "waiting":
+                    lg.info(f"{url} is downloaded by another process")
+                    return
+                stored = claim == "stored"
+            if stored:
+                self.keys.add(key)
+            else:
+                self.pending[key] = [(dest, callback)]
+
+        if stored:
+            lg.info(f"Linking stored {url}")
+            self.link(self.path(key), dest)
+            if callback:
+                callback(url, dest)
+        else:
+            errback = functools.partial(self.failed, downloader)
+            downloader.add_url(
+                url, self.path(key), self.stored, errback=errback, **kwargs
+            )
+
+    def claim(self, key, dest):
+        """Claim the download of key for this process.
+
+        Return "claimed", "stored" if another process stored it already, or
+        "waiting" after leaving dest for the process downloading it.
+        """
+        with self.transaction():
+            row = self.db.execute(
+                "SELECT stored, pid, claimed FROM claims WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[0]:
+                return "stored"
+            if row and pid_alive(row[1]) and time.time() - row[2] < CLAIM_TIMEOUT:
+                self.db.execute("INSERT INTO waiting VALUES (?, ?)", (key, dest))
+                return "waiting"
+            self.db.execute(
+                "INSERT OR REPLACE INTO claims VALUES (?, 0, ?, ?)",
+                (key, os.getpid(), time.time()),
+            )
+            return "claimed"
+
+    def transaction(self):
+        # called holding self.lock, BEGIN IMMEDIATE locks the file
+        # before the claim is read
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def stored(self, url, path):
+        key = media_key(url)
+        with self.lock, self.transaction():
+            self.db.execute("UPDATE claims SET stored = 1 WHERE key = ?", (key,))
+            others = self.db.execute(
+                "SELECT dest FROM waiting WHERE key = ?", (key,)
+            ).fetchall()
+            self.db.execute("DELETE FROM waiting WHERE key = ?", (key,))
+            self.keys.add(key)
+            waiting = self.pending.pop(key, [])
+        # the paths of the other processes are linked without their callbacks
+        for dest, callback in waiting + [(dest, None) for dest, in others]:
+            self.link(path, dest)
+            if callback:
+                callback(url, dest)
+
+    def failed(self, downloader, url, path, reason):
+        """Release the claim of a download given up, and dead-letter the
+        paths waiting for it."""
+        key = media_key(url)
+        with self.lock, self.transaction():
+            self.db.execute("DELETE FROM claims WHERE key = ?", (key,))
+            others = self.db.execute(
+                "SELECT dest FROM waiting WHERE key = ?", (key,)
+            ).fetchall()
+            self.db.execute("DELETE FROM waiting WHERE key = ?", (key,))
+            waiting = self.pending.pop(key, [])
+        for dest in [dest for dest, _ in waiting] + [dest for dest, in others]:
+            downloader.failed.append((url, dest, reason))
+
+    def link(self, path, dest):
+        prepare_dir(dest)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if self.link_type == "hard":
+            try:
+                os.link(path, dest)
+                return
+            except OSError as e:
+                # e.g. the store is on another file system
+                lg.warning(f"Can not hard link {dest}, using a symlink: {e}")
+        os.symlink(os.path.relpath(path, os.path.dirname(dest)), dest)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import statistics
+import threading
+import time
+
+from .exceptions import HTTPStatusError, IncompleteDownloadError
+
+lg = logging.getLogger("throttle")
+
+# statuses telling that the media hosts are overloaded
+CONGESTION_STATUSES = {408, 429, 503, 504}
+
+
+def is_congestion(error):
+    """Whether a failed download hints at sending less traffic."""
+    if isinstance(error, HTTPStatusError):
+        return error.status in CONGESTION_STATUSES
+    return isinstance(
+        error, (IncompleteDownloadError, asyncio.TimeoutError, ConnectionError)
+    )
+
+
+class AdaptiveConcurrency:
+    """Choose the number of downloads run at the same time (AIMD).
+
+    The downloads are counted in windows of `limit` downloads. After each
+    window the limit grows by one, unless the latency of the responses
+    went far above the lowest one seen, which lowers it by one, or the
+    bytes per second did not grow with the last increase, which keeps it.
+    A throttled or timed out download cuts the limit by `decrease`, at
+    most once per window.
+
+    Args:
+        initial: The limit to start from.
+        minimum: The lowest limit.
+        maximum: The highest limit.
+        decrease: Factor of the limit after a congestion.
+        tolerance: Latency over the lowest one seen taken as queueing.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, decrease=0.5, tolerance=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.value = min(max(initial, minimum), maximum)
+        self.min_latency = None
+        self.last_rate = 0.0
+        self.new_window()
+
+    @property
+    def limit(self):
+        return self.value
+
+    def new_window(self):
+        self.window_start = time.monotonic()
+        self.done = 0
+        self.bytes = 0
+        self.latencies = []
+        self.cut = False
+
+    def add_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+
+    def sample(self, latency):
+        """Record the time to the response headers of a request."""
+        with self.lock:
+            self.latencies.append(latency)
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+
+    def success(self):
+        with self.lock:
+            self.done += 1
+            if self.done >= self.value:
+                self.adjust()
+
+    def failure(self, error):
+        if not is_congestion(error):
+            return
+        with self.lock:
+            if self.cut:
+                return
+            self.set(int(self.value * self.decrease))
+            lg.info(f"concurrency cut to {self.value} after {error!r}")
+            self.new_window()
+            self.cut = True
+
+    def adjust(self):
+        elapsed = max(time.monotonic() - self.window_start, 1e-6)
+        rate = self.bytes / elapsed
+        latency = statistics.median(self.latencies) if self.latencies else None
+        if latency and latency > self.tolerance * self.min_latency:
+            self.set(self.value - 1)
+        elif rate >= self.last_rate:
+            self.set(self.value + 1)
+        lg.debug(
+            f"concurrency {self.value}, {rate / 2**20:.1f} MB/s, latency {latency}"
+        )
+        self.last_rate = rate
+        self.new_window()
+
+    def set(self, value):
+        self.value = min(max(value, self.minimum), self.maximum)
+
+
+class Bandwidth:
+    """A token bucket capping the bytes per second of every download.
+
+    It is shared by the worker threads, each waiting in its own event loop.
+
+    Args:
+        rate: Bytes per second.
+        burst: Bytes which may be received at once, one second by default.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, n):
+        """Take n bytes from the bucket and return the seconds to wait."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # the bucket may go below zero, the next takers wait for it
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    async def take(self, n):
+        delay = self.reserve(n)
+        if delay > 0:
+            await asyncio.sleep(delay)
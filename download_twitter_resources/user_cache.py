@@ -0,0 +1,56 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .auth import cache_path
+
+
+class UserCache:
+    """User objects looked up before, kept in a SQLite file.
+
+    Args:
+        path: The SQLite file, under ~/.cache by default.
+        ttl: Seconds a user object is reused before looking it up again.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        self.path = path or cache_path("users.sqlite")
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS users"
+            " (id INTEGER PRIMARY KEY, user TEXT, fetched REAL)"
+        )
+
+    def get_many(self, ids):
+        """Return a dict of the users of ids found in the cache."""
+        rv = {}
+        since = time.time() - self.ttl
+        with self.lock:
+            # stay below the limit of SQL variables
+            for i in range(0, len(ids), 500):
+                chunk = list(ids[i : i + 500])
+                marks = ",".join("?" * len(chunk))
+                rows = self.db.execute(
+                    f"SELECT id, user FROM users WHERE id IN ({marks}) AND fetched > ?",
+                    chunk + [since],
+                )
+                rv.update((id, json.loads(user)) for id, user in rows)
+        return rv
+
+    def put_many(self, users):
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                [(u["id"], json.dumps(u, ensure_ascii=False), now) for u in users],
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -41,6 +41,7 @@ setup(
     long_description=long_description,  # Optional
     long_description_content_type="text/markdown",  # Optional
     install_requires=install_requires,
+    extras_require={"fast": ["orjson"]},
     # You can use `find_packages()` or the `py_modules` argument which expect a
     # single python file
     packages=find_packages(exclude=["contrib", "docs", "tests"]),  # Required
@@ -49,6 +50,8 @@ setup(
             "download-twitter-resources=download_twitter_resources.__main__:main",
             "download-twitter-following=download_twitter_resources.__main__:main_followwing",
             "download-twitter-friends=download_twitter_resources.__main__:main_friends",
+            "download-twitter-batch=download_twitter_resources.__main__:main_batch",
+            "download-twitter-manifest=download_twitter_resources.__main__:main_manifest",
         ]
     },  # Optional
     url=gh_repo,  # Optional
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tests import their helpers as top level modules
+sys.path.insert(0, os.path.dirname(__file__))
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "benchmarks"))
+
+from aiohttp import web
+
+from mock_twitter import MockTwitter, add_arguments
+
+
+def mock_options(*args):
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(["--image-size", "1024", *args])
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class CountingMedia(MockTwitter):
+    """A MockTwitter counting the requests of each media."""
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.hits = collections.Counter()
+
+    async def media(self, request):
+        self.hits[request.match_info["name"]] += 1
+        return await super().media(request)
+
+
+class MockServer:
+    """Serve a MockTwitter in a thread, as a context manager.
+
+    Args:
+        mock: A MockTwitter, or a subclass changing some endpoints.
+    """
+
+    def __init__(self, mock):
+        self.mock = mock
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.runner = web.AppRunner(self.mock.app())
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, "127.0.0.1", self.port)
+        self.loop.run_until_complete(site.start())
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
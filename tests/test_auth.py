@@ -0,0 +1,80 @@
+import builtins
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources.downloader import Downloader
+from download_twitter_resources.exceptions import TokenRejectedError
+
+ENDPOINT = "statuses/user_timeline"
+
+
+class RejectingTwitter(MockTwitter):
+    """Answers 401 for the protected user, and for the first `reject`
+    calls as if the token expired."""
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.tokens = 0
+        self.reject = 0
+
+    async def token(self, request):
+        self.tokens += 1
+        return await super().token(request)
+
+    async def user_timeline(self, request):
+        if self.reject:
+            self.reject -= 1
+            errors = [{"code": 89, "message": "Invalid or expired token."}]
+            return web.json_response({"errors": errors}, status=401)
+        if request.query["screen_name"] == "protected":
+            body = {"request": request.path, "error": "Not authorized."}
+            return web.json_response(body, status=401)
+        return await super().user_timeline(request)
+
+
+class RenewTest(unittest.TestCase):
+    def setUp(self):
+        self.mock = RejectingTwitter(mock_options())
+
+    def get(self, downloader, user):
+        return downloader.api_get(ENDPOINT, {"screen_name": user, "count": 1})
+
+    def test_protected_user_keeps_token(self):
+        with MockServer(self.mock) as server:
+            downloader = Downloader("key", "secret", api_root=server.url)
+            self.assertEqual(self.get(downloader, "protected").status_code, 401)
+            self.assertEqual(self.get(downloader, "mock").status_code, 200)
+            downloader.d.join()
+        self.assertEqual(self.mock.tokens, 1)
+
+    def test_expired_bearer_renewed(self):
+        with MockServer(self.mock) as server:
+            downloader = Downloader("key", "secret", api_root=server.url)
+            self.mock.reject = 1
+            self.assertEqual(self.get(downloader, "mock").status_code, 200)
+            downloader.d.join()
+        self.assertEqual(self.mock.tokens, 2)
+
+    def test_private_never_prompts(self):
+        with MockServer(self.mock) as server:
+            downloader = Downloader(
+                "key",
+                "secret",
+                "token",
+                "token secret",
+                private=True,
+                api_root=server.url,
+            )
+            self.assertEqual(self.get(downloader, "protected").status_code, 401)
+            self.mock.reject = 1
+            with mock.patch.object(builtins, "input", side_effect=EOFError):
+                with self.assertRaises(TokenRejectedError):
+                    self.get(downloader, "mock")
+            downloader.d.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
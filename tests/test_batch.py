@@ -0,0 +1,107 @@
+import contextlib
+import functools
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources import __main__ as cli
+from download_twitter_resources.downloader import Downloader
+
+TWEET = 10**18 + 5
+
+
+class TweetUrlTest(unittest.TestCase):
+    def test_schemes(self):
+        for url in [
+            f"https://twitter.com/a/status/{TWEET}",
+            f"http://twitter.com/a/status/{TWEET}",
+            f"twitter.com/a/status/{TWEET}/photo/1",
+            f"https://mobile.twitter.com/a/status/{TWEET}?s=20",
+            str(TWEET),
+        ]:
+            self.assertTrue(cli.is_tweet(url), url)
+            self.assertEqual(cli.get_tweet_id(url), str(TWEET))
+
+    def test_not_tweets(self):
+        for line in ["mock", "@mock", "https://twitter.com/a/status/abc"]:
+            self.assertFalse(cli.is_tweet(line), line)
+            self.assertRaises(ValueError, cli.get_tweet_id, line)
+        self.assertFalse(cli.is_user("https://twitter.com/a/status/abc"))
+
+    def test_shard(self):
+        # a tweet lands in the same shard whatever its url
+        shards = {
+            cli.shard_of(url, 4)
+            for url in [str(TWEET), f"http://twitter.com/a/status/{TWEET}"]
+        }
+        self.assertEqual(len(shards), 1)
+        self.assertIn(cli.shard_of("https://twitter.com/a/status/abc", 4), range(4))
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, "dest")
+        self.source = os.path.join(self.tmp.name, "list.txt")
+        self.confidential = os.path.join(self.tmp.name, "conf.json")
+        with open(self.confidential, "w") as f:
+            json.dump({"consumer_key": "key", "consumer_secret": "secret"}, f)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_batch(self, lines, *args):
+        with open(self.source, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        out = io.StringIO()
+        with MockServer(MockTwitter(mock_options())) as server:
+            downloader = functools.partial(Downloader, api_root=server.url)
+            argv = ["x", self.source, self.dest, "-c", self.confidential, *args]
+            argv.append("--no-token-cache")
+            with contextlib.ExitStack() as stack:
+                stack.enter_context(
+                    mock.patch(
+                        "download_twitter_resources.downloader.Downloader", downloader
+                    )
+                )
+                stack.enter_context(mock.patch.object(sys, "argv", argv))
+                stack.enter_context(contextlib.redirect_stdout(out))
+                cli.main_batch()
+        summaries = {}
+        for line in out.getvalue().splitlines():
+            resource_id, _, summary = line.partition(" ")
+            if resource_id in lines:
+                summaries[resource_id] = json.loads(summary)
+        return summaries
+
+    def test_any_scheme(self):
+        bad = "https://twitter.com/mock/status/abc"
+        lines = [
+            f"http://twitter.com/mock/status/{TWEET}",
+            f"twitter.com/mock/status/{TWEET + 1}",
+            bad,
+        ]
+        summaries = self.run_batch(lines)
+        self.assertEqual(summaries[lines[0]]["media"], 1)
+        self.assertEqual(summaries[lines[1]]["media"], 1)
+        self.assertIn("error", summaries[bad])
+        for id in [TWEET, TWEET + 1]:
+            self.assertTrue(os.path.exists(os.path.join(self.dest, f"{id}-1.jpg")))
+
+    def test_shards(self):
+        lines = [
+            f"http://twitter.com/mock/status/{TWEET + i}" for i in range(8)
+        ] + ["https://twitter.com/mock/status/abc"]
+        crawled = {}
+        for i in range(2):
+            crawled.update(self.run_batch(lines, "--shard", f"{i}/2"))
+        self.assertEqual(sorted(crawled), sorted(lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
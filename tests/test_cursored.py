@@ -0,0 +1,32 @@
+import unittest
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources.downloader import Downloader
+
+
+class CursoredTest(unittest.TestCase):
+    def pages(self, get, count):
+        rv = []
+        while 1:
+            rv.append(get("mock", count=count))
+            if get.__self__.next_user_cursor is None:
+                return rv
+
+    def test_pages(self):
+        with MockServer(MockTwitter(mock_options("--users", "450"))) as server:
+            downloader = Downloader("key", "secret", api_root=server.url)
+            for get, key in [
+                (downloader.get_friends, "id"),
+                (downloader.get_following, "id"),
+                (downloader.get_friend_ids, None),
+                (downloader.get_following_ids, None),
+            ]:
+                pages = self.pages(get, 200)
+                self.assertEqual([len(x) for x in pages], [200, 200, 50])
+                items = [x[key] if key else x for page in pages for x in page]
+                self.assertEqual(items, list(range(450)))
+            downloader.d.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
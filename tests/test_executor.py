@@ -0,0 +1,106 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from helpers import CountingMedia, MockServer, mock_options
+from download_twitter_resources import async_executor
+from download_twitter_resources.async_executor import (
+    RESUME_SIZE,
+    AsyncDownloader,
+    ConcurrentDownloader,
+)
+
+
+def failing_callback(url, dest):
+    raise RuntimeError("callback failed")
+
+
+class CallbackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mock = CountingMedia(mock_options())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check_failing_callback(self, d):
+        called = []
+        with MockServer(self.mock) as server:
+            d.start()
+            url = f"{server.url}/media/1-0.jpg:orig"
+            d.add_url(url, self.dest("1.jpg"), failing_callback)
+            d.add_url(
+                f"{server.url}/media/2-0.jpg:orig",
+                self.dest("2.jpg"),
+                lambda url, dest: called.append(dest),
+            )
+            d.join()
+
+        self.assertTrue(os.path.exists(self.dest("1.jpg")))
+        self.assertEqual(called, [self.dest("2.jpg")])
+        # the download is neither retried nor given up
+        self.assertEqual(self.mock.hits["1-0.jpg:orig"], 1)
+        self.assertEqual(d.failed, [])
+
+    def dest(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_thread_engine(self):
+        self.check_failing_callback(AsyncDownloader())
+
+    def test_asyncio_engine(self):
+        self.check_failing_callback(ConcurrentDownloader())
+
+
+class PartialTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.mock = CountingMedia(mock_options("--video-size", str(2 * RESUME_SIZE)))
+        self.dest = os.path.join(self.tmp.name, "1.mp4")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def download(self, name, **kwargs):
+        d = AsyncDownloader(**kwargs)
+        with MockServer(self.mock) as server:
+            d.start(1)
+            d.add_url(f"{server.url}/media/{name}", self.dest)
+            d.join()
+        with open(self.dest, "rb") as f:
+            return f.read()
+
+    def test_small_without_sidecar(self):
+        # a part of an earlier version, not resumed without its sidecar
+        with open(self.dest + ".part", "wb") as f:
+            f.write(b"stale")
+        save = mock.patch.object(
+            async_executor, "save_part_meta", wraps=async_executor.save_part_meta
+        )
+        with save as save_part_meta:
+            self.assertEqual(self.download("1-0.jpg"), self.mock.image)
+            save_part_meta.assert_not_called()
+            self.assertEqual(self.download("1-0.mp4"), self.mock.video)
+            save_part_meta.assert_called_once()
+
+    def test_resume(self):
+        half = len(self.mock.video) // 2
+        with open(self.dest + ".part", "wb") as f:
+            f.write(self.mock.video[:half])
+        with open(self.dest + ".part.json", "w") as f:
+            json.dump({"validator": None, "length": len(self.mock.video)}, f)
+        self.assertEqual(self.download("1-0.mp4"), self.mock.video)
+        self.assertEqual(os.listdir(self.tmp.name), ["1.mp4"])
+
+    def test_split(self):
+        body = self.download("1-0.mp4", split_size=RESUME_SIZE, segments=4)
+        self.assertEqual(body, self.mock.video)
+        # the first request and a range per segment
+        self.assertEqual(self.mock.hits["1-0.mp4"], 5)
+        self.assertEqual(os.listdir(self.tmp.name), ["1.mp4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import contextlib
+import functools
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources import __main__ as cli
+from download_twitter_resources.downloader import Downloader
+from download_twitter_resources.export import UserExport
+
+
+class PagedIds(MockTwitter):
+    """Pages of 200 ids, and a lookup failing `fail` times on user 250."""
+
+    def __init__(self, options):
+        super().__init__(options)
+        self.fail = 0
+
+    async def ids(self, request):
+        return await super().ids(
+            request.clone(rel_url=request.rel_url.update_query(count=200))
+        )
+
+    async def lookup(self, request):
+        if self.fail and "250" in request.query["user_id"].split(","):
+            self.fail -= 1
+            return web.Response(status=503)
+        return await super().lookup(request)
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = os.path.join(self.tmp.name, "mock.friends.ndjson")
+        self.confidential = os.path.join(self.tmp.name, "conf.json")
+        with open(self.confidential, "w") as f:
+            json.dump({"consumer_key": "key", "consumer_secret": "secret"}, f)
+        self.mock = PagedIds(mock_options("--users", "450"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_cli(self, server, *args):
+        downloader = functools.partial(Downloader, api_root=server.url)
+        argv = ["x", "mock", "-c", self.confidential, "-o", self.output, *args]
+        out = io.StringIO()
+        with mock.patch("download_twitter_resources.downloader.Downloader", downloader):
+            with mock.patch.object(sys, "argv", argv), contextlib.redirect_stdout(out):
+                cli.main_friends()
+        return out.getvalue()
+
+    def ids(self):
+        with open(self.output) as f:
+            return [json.loads(line)["id"] for line in f]
+
+    def test_hydrate_failure(self):
+        args = ["--ids", "--hydrate", "--no-user-cache"]
+        with MockServer(self.mock) as server:
+            self.mock.fail = 1
+            out = self.run_cli(server, *args)
+            self.assertNotIn("finished!", out)
+            self.assertEqual(self.ids(), list(range(200)))
+            self.assertTrue(os.path.exists(self.output + ".cursor"))
+
+            out = self.run_cli(server, *args)
+        self.assertIn("finished!", out)
+        self.assertEqual(self.ids(), list(range(450)))
+        self.assertFalse(os.path.exists(self.output + ".cursor"))
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def interrupted(self, name):
+        """Write a page and the start of the next one, as a killed run does."""
+        path = os.path.join(self.tmp.name, name)
+        export = UserExport(path)
+        self.assertEqual(export.resume(), -1)
+        export.write([{"id": 1}, {"id": 2}], 2)
+        with export.open() as f:
+            f.write('{"id": 3}\n{"id"')
+        return path
+
+    def read(self, path):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt") as f:
+            return [json.loads(line)["id"] for line in f]
+
+    def test_resume(self):
+        for name in ["users.ndjson", "users.ndjson.gz"]:
+            path = self.interrupted(name)
+            export = UserExport(path)
+            self.assertEqual(export.resume(), 2)
+            self.assertEqual(export.count, 2)
+            export.write([{"id": 3}], None)
+            self.assertEqual(self.read(path), [1, 2, 3])
+            self.assertFalse(os.path.exists(path + ".cursor"))
+
+    def test_missing_output(self):
+        for name in ["users.ndjson", "users.ndjson.gz"]:
+            path = self.interrupted(name)
+            os.remove(path)
+            export = UserExport(path)
+            self.assertEqual(export.resume(), -1)
+            self.assertEqual(export.count, 0)
+            export.write([{"id": 1}], None)
+            self.assertEqual(self.read(path), [1])
+
+    def test_shorter_output(self):
+        path = self.interrupted("users.ndjson")
+        with open(path, "r+b") as f:
+            f.truncate(3)
+        self.assertEqual(UserExport(path).resume(), -1)
+        self.assertEqual(os.path.getsize(path), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources.downloader import Downloader, load_since_ids
+
+
+class FailingTimeline(MockTwitter):
+    """Answer 503 to every page of a timeline after the first one."""
+
+    async def user_timeline(self, request):
+        if "max_id" in request.query:
+            return web.Response(status=503)
+        return await super().user_timeline(request)
+
+
+class IncrementalTest(unittest.TestCase):
+    def download(self, mock, dest, limit, pipeline=False):
+        with MockServer(mock) as server:
+            d = Downloader("key", "secret", api_root=server.url)
+            summary = d.download_images_of_user(
+                "mock", dest, limit=limit, incremental=True, pipeline=pipeline
+            )
+            d.d.join()
+        return summary, load_since_ids(dest)
+
+    def test_failed_page_keeps_since_id(self):
+        with tempfile.TemporaryDirectory() as dest:
+            mock = FailingTimeline(mock_options("--tweets", "600"))
+            summary, since_ids = self.download(mock, dest, 3200)
+            self.assertEqual(summary["tweets"], 200)
+            self.assertEqual(since_ids, {})
+
+    def test_failed_page_keeps_since_id_in_pipeline(self):
+        with tempfile.TemporaryDirectory() as dest:
+            mock = FailingTimeline(mock_options("--tweets", "600"))
+            summary, since_ids = self.download(mock, dest, 3200, pipeline=True)
+            self.assertEqual(summary["tweets"], 200)
+            self.assertEqual(since_ids, {})
+
+    def test_complete_timeline_saves_since_id(self):
+        with tempfile.TemporaryDirectory() as dest:
+            mock = MockTwitter(mock_options("--tweets", "600"))
+            summary, since_ids = self.download(mock, dest, 3200)
+            self.assertEqual(summary["tweets"], 600)
+            self.assertEqual(since_ids, {"mock": mock.newest})
+
+    def test_limit_saves_since_id(self):
+        with tempfile.TemporaryDirectory() as dest:
+            mock = MockTwitter(mock_options("--tweets", "600"))
+            summary, since_ids = self.download(mock, dest, 100)
+            self.assertEqual(summary["tweets"], 100)
+            self.assertEqual(since_ids, {"mock": mock.newest})
+
+
+if __name__ == "__main__":
+    unittest.main()
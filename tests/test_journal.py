@@ -0,0 +1,126 @@
+import functools
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from download_twitter_resources import downloader as downloader_module
+
+from helpers import CountingMedia, MockServer, MockTwitter, mock_options
+from download_twitter_resources import __main__ as cli
+from download_twitter_resources.downloader import Downloader
+from download_twitter_resources.journal import Journal
+
+TWEET = 10**18 + 5
+
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = os.path.join(self.tmp.name, "dest")
+        self.confidential = os.path.join(self.tmp.name, "conf.json")
+        with open(self.confidential, "w") as f:
+            json.dump({"consumer_key": "key", "consumer_secret": "secret"}, f)
+        self.mock = CountingMedia(mock_options())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def journal_pending_tweet(self, server):
+        """Leave the download of TWEET pending, as a killed run would."""
+        journal = Journal(self.dest)
+        url = f"{server.url}/media/{TWEET}-0.jpg:orig"
+        journal.add(url, os.path.join(self.dest, f"{TWEET}-1.jpg"))
+        journal.close()
+
+    def run_cli(self, server, main, *args):
+        downloader = functools.partial(Downloader, api_root=server.url)
+        argv = ["x", *args, "-c", self.confidential, "--journal", "--no-token-cache"]
+        with mock.patch("download_twitter_resources.downloader.Downloader", downloader):
+            with mock.patch.object(sys, "argv", argv):
+                main()
+
+    def assert_resumed(self):
+        self.assertTrue(os.path.exists(os.path.join(self.dest, f"{TWEET}-1.jpg")))
+        self.assertEqual(Journal(self.dest).pending(), [])
+        self.assertEqual(self.mock.hits[f"{TWEET}-0.jpg:orig"], 1)
+
+    def test_tweet(self):
+        with MockServer(self.mock) as server:
+            self.journal_pending_tweet(server)
+            self.run_cli(server, cli.main, str(TWEET), self.dest, "--tweet")
+        self.assert_resumed()
+
+    def test_batch_processes(self):
+        source = os.path.join(self.tmp.name, "list.txt")
+        with open(source, "w") as f:
+            f.write(f"https://twitter.com/mock/status/{TWEET}\n")
+            f.write(f"https://twitter.com/mock/status/{TWEET + 1}\n")
+        with MockServer(self.mock) as server:
+            self.journal_pending_tweet(server)
+            self.run_cli(
+                server, cli.main_batch, source, self.dest, "--processes", "2"
+            )
+        self.assert_resumed()
+
+
+class CountingTimeline(MockTwitter):
+    def __init__(self, options):
+        super().__init__(options)
+        self.pages = 0
+
+    async def user_timeline(self, request):
+        self.pages += 1
+        return await super().user_timeline(request)
+
+
+class ResumeTimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+        self.mock = CountingTimeline(mock_options("--tweets", "1000"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_pipeline_counts_checked_tweets(self):
+        # an earlier run checked 300 of the 400 tweets of the limit
+        journal = Journal(self.dest)
+        journal.save_cursor("mock", self.mock.newest - 300, 300, self.mock.newest)
+        journal.close()
+        with MockServer(self.mock) as server:
+            d = Downloader("key", "secret", api_root=server.url, journal=True)
+            summary = d.download_images_of_user(
+                "mock", self.dest, limit=400, pipeline=True
+            )
+            d.d.join()
+        self.assertGreaterEqual(summary["tweets"], 400)
+        # a page of 200 tweets reaches the limit, no other is fetched
+        self.assertEqual(self.mock.pages, 1)
+
+    def test_pipeline_stops_on_error(self):
+        threads = []
+        start = downloader_module.run_in_thread
+
+        def run_in_thread(*args):
+            threads.append(start(*args))
+            return threads[-1]
+
+        with MockServer(self.mock) as server:
+            d = Downloader("key", "secret", api_root=server.url)
+            failing = mock.patch.object(
+                d, "process_tweet", side_effect=RuntimeError("failed")
+            )
+            spawn = mock.patch.object(downloader_module, "run_in_thread", run_in_thread)
+            with failing, spawn, self.assertRaises(RuntimeError):
+                d.download_images_of_user("mock", self.dest, pipeline=True, prefetch=1)
+            threads[0].join(5)
+            self.assertFalse(threads[0].is_alive())
+            d.d.join()
+        self.assertLess(self.mock.pages, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+
+from helpers import CountingMedia, MockServer, mock_options
+from download_twitter_resources.downloader import Downloader
+from download_twitter_resources.manifest import Manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dest = self.tmp.name
+        self.mock = CountingMedia(mock_options())
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.dest, name)
+
+    def save_shared_media(self, **kwargs):
+        with MockServer(self.mock) as server:
+            url = f"{server.url}/media/1-0.jpg"
+            downloader = Downloader(
+                "key", "secret", api_root=server.url, manifest=True, **kwargs
+            )
+            downloader.save_media(url, self.dest, "1-1", "orig")
+            downloader.d.join()
+            # the same media in a retweet
+            downloader.save_media(url, self.dest, "2-1", "orig")
+            downloader.d.join()
+        return Manifest(self.dest)
+
+    def test_link_saved_url(self):
+        manifest = self.save_shared_media()
+        self.assertEqual(self.mock.hits["1-0.jpg:orig"], 1)
+        with open(self.path("2-1.jpg"), "rb") as f:
+            self.assertEqual(f.read(), self.mock.image)
+        self.assertTrue(os.path.samefile(self.path("1-1.jpg"), self.path("2-1.jpg")))
+        self.assertIn("2-1.jpg", manifest)
+
+    def test_with_store(self):
+        store = os.path.join(self.dest, "store")
+        self.save_shared_media(store=store)
+        self.assertEqual(self.mock.hits["1-0.jpg:orig"], 1)
+        self.assertTrue(os.path.samefile(self.path("1-1.jpg"), self.path("2-1.jpg")))
+
+
+if __name__ == "__main__":
+    unittest.main()
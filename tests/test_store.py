@@ -0,0 +1,58 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+
+from helpers import MockServer, MockTwitter, mock_options
+from download_twitter_resources.async_executor import AsyncDownloader
+from download_twitter_resources.retry import RetryPolicy
+from download_twitter_resources.store import MediaStore, media_key
+
+
+class MissingMedia(MockTwitter):
+    async def media(self, request):
+        # slow enough for the other paths to wait for the download
+        await asyncio.sleep(0.2)
+        return web.Response(status=404)
+
+
+class StoreFailureTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = MediaStore(os.path.join(self.tmp.name, "store"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dest(self, name):
+        return os.path.join(self.tmp.name, "dest", name)
+
+    def test_given_up(self):
+        with MockServer(MissingMedia(mock_options())) as server:
+            url = f"{server.url}/media/1-0.jpg:orig"
+            key = media_key(url)
+            d = AsyncDownloader(retry=RetryPolicy(1))
+            d.start(1)
+            self.store.fetch(d, url, self.dest("a.jpg"))
+            self.store.fetch(d, url, self.dest("b.jpg"))
+            # left by another process sharing the store
+            self.store.db.execute(
+                "INSERT INTO waiting VALUES (?, ?)", (key, self.dest("other.jpg"))
+            )
+            d.join()
+
+        self.assertEqual(self.store.pending, {})
+        claims = self.store.db.execute("SELECT * FROM claims").fetchall()
+        self.assertEqual(claims, [])
+        self.assertEqual(self.store.db.execute("SELECT * FROM waiting").fetchall(), [])
+        failed = sorted(os.path.basename(dest) for url, dest, reason in d.failed)
+        self.assertEqual(failed, ["1-0-orig.jpg", "a.jpg", "b.jpg", "other.jpg"])
+
+        # the media is claimed again by the next run
+        self.assertEqual(self.store.claim(key, self.dest("a.jpg")), "claimed")
+
+
+if __name__ == "__main__":
+    unittest.main()
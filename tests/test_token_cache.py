@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+import stat
+import tempfile
+import unittest
+
+from download_twitter_resources.auth import TokenCache
+
+
+def fill(path, worker, count):
+    cache = TokenCache(path)
+    for i in range(count):
+        cache.set(f"{worker}:{i}", i)
+
+
+class TokenCacheTest(unittest.TestCase):
+    def test_concurrent_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "tokens.json")
+            processes = [
+                multiprocessing.Process(target=fill, args=(path, worker, 50))
+                for worker in range(8)
+            ]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+            self.assertEqual([p.exitcode for p in processes], [0] * 8)
+
+            cache = TokenCache(path)
+            self.assertEqual(len(cache.load()), 8 * 50)
+            self.assertEqual(cache.get("7:49"), 49)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+            self.assertEqual([x for x in os.listdir(tmp) if x.endswith(".tmp")], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+from download_twitter_resources.auth import TokenPool, TwitterAuth
+
+ENDPOINT = "statuses/user_timeline"
+
+
+def make_auth(key):
+    # private with an access token, so that no request is sent
+    return TwitterAuth(key, "secret", "token", "token secret", private=True)
+
+
+class TokenPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.budgets = os.path.join(self.tmp.name, "budgets.sqlite")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def remaining(self):
+        with sqlite3.connect(self.budgets) as db:
+            return dict(db.execute("SELECT token, remaining FROM budgets"))
+
+    def test_shared_budget_not_overspent(self):
+        reset = int(time.time()) + 2
+        headers = {
+            "x-rate-limit-limit": "10",
+            "x-rate-limit-remaining": "10",
+            "x-rate-limit-reset": str(reset),
+        }
+        pool = TokenPool([make_auth("a")], budgets=self.budgets)
+        pool.tokens[0].limiter.update(ENDPOINT, headers)
+
+        # pools of separate processes, each with its own connection
+        pools = [TokenPool([make_auth("a")], budgets=self.budgets) for _ in range(8)]
+        times = []
+        start = threading.Barrier(len(pools))
+
+        def run(pool):
+            start.wait()
+            for _ in range(2):
+                pool.acquire(ENDPOINT)
+                times.append(time.time())
+
+        threads = [threading.Thread(target=run, args=(p,)) for p in pools]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(times), 16)
+        self.assertEqual(len([t for t in times if t < reset]), 10)
+        self.assertEqual(list(self.remaining().values()), [0])
+
+    def test_most_budget_first(self):
+        pool = TokenPool([make_auth("a"), make_auth("b")], budgets=self.budgets)
+        reset = str(int(time.time()) + 60)
+        for token, remaining in zip(pool.tokens, ["3", "5"]):
+            token.limiter.update(
+                ENDPOINT,
+                {
+                    "x-rate-limit-limit": "5",
+                    "x-rate-limit-remaining": remaining,
+                    "x-rate-limit-reset": reset,
+                },
+            )
+        names = [pool.acquire(ENDPOINT).name for _ in range(4)]
+        self.assertEqual(names[:2], ["1", "1"])
+        self.assertEqual(sorted(self.remaining().values()), [2, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()